@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    Sonny
+#
+#    Copyright (C) 2018  Marko Kosmerl
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import division, print_function, absolute_import
+
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from sonny.common.config import (
+    REDIS_CODEC,
+    REDIS_COMPRESSION
+)
+
+__author__ = "Marko Kosmerl"
+__copyright__ = "Marko Kosmerl"
+__license__ = "gpl3"
+
+# Values written by a codec other than plain json start with a header of
+# 3 bytes: magic byte, codec id and compression id. Plain json values have
+# no header so that they stay readable by older readers.
+MAGIC = b'\x00'
+
+CODECS = {
+    'json': b'j',
+    'msgpack': b'm',
+}
+
+COMPRESSIONS = {
+    'none': b'n',
+    'zlib': b'z',
+    'lz4': b'l',
+}
+
+
+def _serialize(obj, codec):
+    if codec == 'msgpack':
+        if msgpack is None:
+            raise Exception('msgpack codec requires msgpack package')
+        return msgpack.packb(obj, use_bin_type=True)
+
+    return json.dumps(obj).encode('utf-8')
+
+
+def _deserialize(value, codec_id):
+    if codec_id == CODECS['msgpack']:
+        if msgpack is None:
+            raise Exception('msgpack codec requires msgpack package')
+        return msgpack.unpackb(value, raw=False)
+
+    return json.loads(value)
+
+
+def _compress(value, compression):
+    if compression == 'zlib':
+        return zlib.compress(value)
+    elif compression == 'lz4':
+        if lz4 is None:
+            raise Exception('lz4 compression requires lz4 package')
+        return lz4.frame.compress(value)
+
+    return value
+
+
+def _decompress(value, compression_id):
+    if compression_id == COMPRESSIONS['zlib']:
+        return zlib.decompress(value)
+    elif compression_id == COMPRESSIONS['lz4']:
+        if lz4 is None:
+            raise Exception('lz4 compression requires lz4 package')
+        return lz4.frame.decompress(value)
+
+    return value
+
+
+def dumps(obj, codec=None, compression=None):
+    """
+    Encode obj with the configured codec and compression.
+    """
+    codec = codec or REDIS_CODEC
+    compression = compression or REDIS_COMPRESSION
+
+    value = _serialize(obj, codec)
+    if codec == 'json' and compression == 'none':
+        return value
+
+    header = MAGIC + CODECS[codec] + COMPRESSIONS[compression]
+    return header + _compress(value, compression)
+
+
+def loads(value):
+    """
+    Decode value written by dumps with any codec and compression.
+    """
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+
+    if not value.startswith(MAGIC):
+        return json.loads(value)
+
+    codec_id, compression_id = value[1:2], value[2:3]
+    return _deserialize(_decompress(value[3:], compression_id), codec_id)
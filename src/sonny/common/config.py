@@ -46,19 +46,62 @@ COOLDOWN_PERIOD = int(config['DEFAULT'].get('cooldown_period', 86400))
 MONITOR_PERIOD = int(config['DEFAULT'].get('monitor_period', 60))
 SUSPICIOUS_BACKOFF = int(config['DEFAULT'].get('suspicious_backoff', 5))
 DEAD_BACKOFF = int(config['DEFAULT'].get('dead_backoff', 1))
+SERVERS_FULL_SYNC_PERIOD = int(
+    config['DEFAULT'].get('servers_full_sync_period', 3600))
+SERVERS_PAGE_SIZE = int(config['DEFAULT'].get('servers_page_size', 1000))
+INVENTORY_TIMEOUT = int(config['DEFAULT'].get('inventory_timeout', 60))
+NS4_WORKER = config['DEFAULT'].get('ns4_worker', 'simple')
+SCANNER = config['DEFAULT'].get('scanner', 'nmap')
+SCAN_CONCURRENCY = int(config['DEFAULT'].get('scan_concurrency', 500))
+SCAN_TIMEOUT = float(config['DEFAULT'].get('scan_timeout', 2))
+SCAN_RETRIES = int(config['DEFAULT'].get('scan_retries', 1))
+SCAN_SHARD_SIZE = int(config['DEFAULT'].get('scan_shard_size', 256))
+SCAN_MAX_JOBS = int(config['DEFAULT'].get('scan_max_jobs', 8))
+INSTANCE_PROBE = config['DEFAULT'].get('instance_probe', 'all')
+PROBE_SAMPLE_SIZE = int(config['DEFAULT'].get('probe_sample_size', 5))
+PROBE_INTERVAL = float(config['DEFAULT'].get('probe_interval', 10))
+PROBE_MAX_AGE = float(config['DEFAULT'].get('probe_max_age', 30))
+MONITOR_MODE = config['DEFAULT'].get('monitor_mode', 'sequential')
+AGENTS_PERIOD = int(config['DEFAULT'].get('agents_period', 10))
+MONITOR_CADENCE = config['DEFAULT'].get('monitor_cadence', 'fixed')
+MONITOR_MIN_PERIOD = int(config['DEFAULT'].get('monitor_min_period', 10))
+MONITOR_MAX_PERIOD = int(config['DEFAULT'].get('monitor_max_period', 300))
+MONITOR_CALM_STEPS = int(config['DEFAULT'].get('monitor_calm_steps', 5))
+RECOVERY_PARALLELISM = int(
+    config['DEFAULT'].get('recovery_parallelism', 10))
+RECOVERY_RATE = float(config['DEFAULT'].get('recovery_rate', 0))
+RECOVERY_MAX_RATE = float(config['DEFAULT'].get('recovery_max_rate', 10))
+RECOVERY_MIN_RATE = float(
+    config['DEFAULT'].get('recovery_min_rate', 0.05))
+RECOVERY_BURST = int(config['DEFAULT'].get('recovery_burst', 10))
+BOOT_LATENCY_TARGET = int(config['DEFAULT'].get('boot_latency_target', 120))
+PROJECT_PRIORITIES = config['DEFAULT'].get('project_priorities')
+PROJECT_PRIORITIES = {
+    project: int(priority) for project, priority in (
+        p.split(':') for p in PROJECT_PRIORITIES.split(','))
+} if PROJECT_PRIORITIES else {}
 
 # OPENSTACK
 CLOUD = config['OPENSTACK'].get('cloud')
 EXT_NET_LIST = config['OPENSTACK'].get('provider_net', 'ext-net').split(',')
+MONITOR_CLOUDS = config['OPENSTACK'].get('monitor_clouds')
+MONITOR_CLOUDS = MONITOR_CLOUDS.split(',') if MONITOR_CLOUDS else []
 
 # MYSQL
 MYSQL_HOST = config['MYSQL'].get('host', None)
 MYSQL_USER = config['MYSQL'].get('user', None)
 MYSQL_PASS = config['MYSQL'].get('pass', None)
+MYSQL_PORT = int(config['MYSQL'].get('port', 3306))
+MYSQL_DB = config['MYSQL'].get('db', 'nova')
 
 # REDIS
 REDIS_HOST = config['REDIS'].get('host')
 REDIS_PASS = config['REDIS'].get('pass', None)
+INVENTORY_LAYOUT = config['REDIS'].get('inventory_layout', 'hash')
+REDIS_CODEC = config['REDIS'].get('codec', 'json')
+REDIS_COMPRESSION = config['REDIS'].get('compression', 'none')
+EVENTS_MAXLEN = int(config['REDIS'].get('events_maxlen', 10000))
+CACHE_SIZE = int(config['REDIS'].get('cache_size_mb', 64)) * 1024 * 1024
 
 # SLACK
 SLACK_TOKEN = config['SLACK'].get('token', '')
@@ -67,3 +110,11 @@ CLOUDS = config['SLACK'].get('clouds')
 CLOUDS = CLOUDS.split(',') if CLOUDS else []
 
 assert REDIS_HOST is not None
+assert NS4_WORKER in ['simple', 'fork']
+assert SCANNER in ['nmap', 'tcp']
+assert INSTANCE_PROBE in ['all', 'sample']
+assert MONITOR_MODE in ['sequential', 'pipelined']
+assert MONITOR_CADENCE in ['fixed', 'adaptive']
+assert INVENTORY_LAYOUT in ['blob', 'hash', 'both']
+assert REDIS_CODEC in ['json', 'msgpack']
+assert REDIS_COMPRESSION in ['none', 'zlib', 'lz4']
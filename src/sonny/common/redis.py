@@ -22,11 +22,23 @@ from __future__ import division, print_function, absolute_import
 
 import hashlib
 import json
+import math
+import sys
+import time
 import yaml
+from collections import OrderedDict
+from itertools import islice
+from uuid import uuid4
 
 from redis import StrictRedis
+from redis.exceptions import WatchError
 
+from sonny.common.codec import dumps, loads
 from sonny.common.config import (
+    CACHE_SIZE,
+    EVENTS_MAXLEN,
+    EXT_NET_LIST,
+    INVENTORY_LAYOUT,
     REDIS_HOST,
     REDIS_PASS
 )
@@ -35,13 +47,190 @@ __author__ = "Marko Kosmerl"
 __copyright__ = "Marko Kosmerl"
 __license__ = "gpl3"
 
+# inventories stored with set_inventory
+ENTITY_INVENTORIES = ['servers', 'hypervisors']
+# number of the last published inventory snapshot
+INVENTORY_GENERATION = 'inventory:generation'
+# stream of inventory changes
+INVENTORY_EVENTS = 'inventory:events'
+
+# server uuid to hypervisor hostname
+SERVERS_HV = 'servers:hypervisor'
+# server uuid to name
+SERVERS_NAME = 'servers:name'
+# lexicographically sorted "<name>\0<uuid>" entries for name lookups
+SERVERS_NAMES = 'servers:names'
+# hypervisor hostname scored by the last time the prober saw it up
+HVS_LAST_SEEN = 'hypervisors:last_seen'
+# start time of the last completed prober sweep
+HVS_PROBE_TIMESTAMP = 'hypervisors:probe:timestamp'
+# hypervisor hostname scored by the newest heartbeat of its agents
+AGENTS_HEARTBEAT = 'agents:heartbeat'
+# compute host to its zone, aggregate and vcpus capacity
+SPARE_PROFILES = 'spares:profiles'
+# keys of spare pools, see spare_pool_key
+SPARE_POOLS = 'spares:pools'
+# seconds a claimed spare is kept out of the spare pool
+SPARE_CLAIM_TTL = 3600
+# seconds a job completion signal is kept for waiters
+JOB_SIGNAL_TTL = 3600
+# seconds staged servers of an unfinished full sync are kept
+STAGING_TTL = 3600
+
+
+def staging_key(key, run_id):
+    return f'{key}:staging:{run_id}'
+
+
+def fingerprint(value):
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+
+
+def diff_entities(old, new):
+    """
+    Per-entity diff of two inventory dicts. Changed entities that are
+    dicts are reduced to their changed fields (with new values).
+    """
+    old, new = old or {}, new or {}
+    added = [k for k in new if k not in old]
+    removed = [k for k in old if k not in new]
+    changed = {}
+
+    for k, value in new.items():
+        if k not in old or old[k] == value:
+            continue
+        if isinstance(value, dict) and isinstance(old[k], dict):
+            changed[k] = {
+                f: value.get(f) for f in set(old[k]) | set(value)
+                if old[k].get(f) != value.get(f)
+            }
+        else:
+            changed[k] = value
+
+    return {'added': added, 'removed': removed, 'changed': changed}
+
+
+def agents_binaries(agents):
+    """
+    Reduce agents dataset to agent binaries per host, heartbeats change on
+    every refresh and are not worth an event.
+    """
+    return {host: sorted(binaries) for host, binaries in agents.items()}
+
+
+# datasets compared by a projection when computing events
+EVENT_PROJECTIONS = {'agents': agents_binaries}
+
+
+def hv_instances_key(hv):
+    return f'hypervisor:{hv}:instances'
+
+
+def job_signal_key(job_id):
+    return f'job:{job_id}:done'
+
+
+def spare_pool_key(zone, aggregate):
+    return f'spares:{zone}:{aggregate}'
+
+
+def spare_claim_key(hv):
+    return f'spare:{hv}:claimed'
+
+
+def is_spare(service, hypervisor):
+    return all([
+        service['state'] == 'up',
+        service['status'] == 'disabled',
+        'spare' in str(service['disables_reason']).lower(),
+        hypervisor['vcpus_used'] == 0,
+    ])
+
+
+def hot_server(server):
+    """
+    Compact projection of a server record with only the fields used by
+    monitor detection and resurrection, addresses are reduced to external
+    network ips.
+    """
+    addresses = server.get('addresses') or {}
+    ips = [
+        addresses[net][0]['addr']
+        for net in EXT_NET_LIST if addresses.get(net)
+    ]
+
+    return {
+        'id': server.get('id'),
+        'name': server['name'],
+        'vm_state': server.get('vm_state'),
+        'hypervisor_hostname': server.get('hypervisor_hostname'),
+        'ips': ips,
+    }
+
+
+def decoded_size(value):
+    """
+    Estimate memory taken by a decoded dataset, shared objects such as
+    interned strings are counted every time they are referenced.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(
+            decoded_size(k) + decoded_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(decoded_size(v) for v in value)
+
+    return size
+
+
+class InventoryCache:
+    """
+    LRU cache of decoded datasets, each one stored together with the
+    fingerprint it was read with. Total estimated size of decoded values
+    is bounded.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, name, version):
+        entry = self._entries.get(name)
+        if not entry or entry[0] != version:
+            return None
+
+        self._entries.move_to_end(name)
+        return entry
+
+    def put(self, name, version, value, size):
+        self.discard(name)
+        if size > self.max_size:
+            return
+
+        self._entries[name] = (version, value, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def discard(self, name):
+        entry = self._entries.pop(name, None)
+        if entry:
+            self.size -= entry[2]
+
 
 class SonnyRedis(StrictRedis):
 
-    def __init__(self, cloud=None):
+    def __init__(self, cloud=None, cache_size=None):
         self.__set_db(cloud)
         super().__init__(host=REDIS_HOST, db=self.db, password=REDIS_PASS)
 
+        cache_size = CACHE_SIZE if cache_size is None else cache_size
+        self._cache = InventoryCache(cache_size) if cache_size else None
+
     @property
     def db(self):
         return self.__db
@@ -54,6 +243,10 @@ class SonnyRedis(StrictRedis):
             self.__db = 0
 
     def get(self, name, value_type=None):
+        if value_type is loads and self._cache is not None:
+            # cached datasets are shared, callers must not modify them
+            return self.get_snapshot(name)[1][name]
+
         value = super().get(name)
 
         if value and value_type is str:
@@ -65,6 +258,752 @@ class SonnyRedis(StrictRedis):
         else:
             return None
 
+    def set_inventory(self, name, entities, pipe=None):
+        """
+        Store inventory dict under name. Depending on the inventory layout
+        it is written as a single encoded blob, as a hash with one field per
+        entity or as both (useful during migration). When pipe is given,
+        commands are only queued on it.
+        """
+        p = pipe or self.pipeline()
+        if INVENTORY_LAYOUT in ['blob', 'both']:
+            p.set(name, dumps(entities))
+        if INVENTORY_LAYOUT in ['hash', 'both']:
+            hash_name = f'{name}:hash'
+            p.delete(hash_name)
+            if entities:
+                p.hmset(hash_name, {
+                    k: dumps(v) for k, v in entities.items()})
+        if not pipe:
+            p.execute()
+
+    def update_inventory(self, name, entities, removed=None, pipe=None):
+        """
+        Update only the given entities of the inventory stored under name
+        and remove the ones listed in removed.
+        """
+        removed = list(removed or [])
+        if not entities and not removed:
+            return
+
+        p = pipe or self.pipeline()
+        if INVENTORY_LAYOUT in ['blob', 'both']:
+            # entities are only replaced, a shallow copy of the possibly
+            # cached inventory is enough
+            inventory = dict(self.get(name, loads) or {})
+            inventory.update(entities)
+            for key in removed:
+                inventory.pop(key, None)
+            p.set(name, dumps(inventory))
+        if INVENTORY_LAYOUT in ['hash', 'both']:
+            if entities:
+                p.hmset(f'{name}:hash', {
+                    k: dumps(v) for k, v in entities.items()})
+            if removed:
+                p.hdel(f'{name}:hash', *removed)
+        if not pipe:
+            p.execute()
+
+    def add_event(self, dataset, event, pipe=None):
+        """
+        Append inventory change to the events stream.
+        """
+        fields = {k: dumps(v) for k, v in event.items()}
+        fields['dataset'] = dataset
+        (pipe or self).xadd(
+            INVENTORY_EVENTS, fields, maxlen=EVENTS_MAXLEN or None)
+
+    def get_events(self, last_id='0', count=None):
+        """
+        Get inventory changes appended after last_id as list of
+        (id, dataset, event) tuples.
+        """
+        events = []
+        start = '-' if last_id == '0' else last_id
+        for event_id, fields in self.xrange(
+                INVENTORY_EVENTS, start, count=count and count + 1):
+            if event_id.decode('utf-8') == last_id:
+                continue
+            dataset = fields.pop(b'dataset').decode('utf-8')
+            event = {k.decode('utf-8'): loads(v) for k, v in fields.items()}
+            events.append((event_id.decode('utf-8'), dataset, event))
+
+        return events[:count] if count else events
+
+    def set_snapshot(self, datasets):
+        """
+        Publish datasets collected by one inventory refresh as a numbered
+        snapshot, written in a single transaction. Datasets with unchanged
+        fingerprint are not rewritten, changes of the others are appended
+        to the events stream (agents only when their binaries change).
+        Heartbeats index of agents is replaced in the same transaction.
+        Returns the snapshot generation which is only incremented when
+        something changed.
+        """
+        names = list(datasets)
+        fingerprints = {name: fingerprint(datasets[name]) for name in names}
+        old_fingerprints = dict(zip(names, self.mget(
+            [f'{name}:fingerprint' for name in names]))) if names else {}
+        changed = [
+            name for name in names
+            if old_fingerprints[name] != fingerprints[name].encode('utf-8')
+        ]
+        now = time.time()
+        pipe = self.pipeline()
+        if not changed:
+            for name in names:
+                pipe.set(f'{name}:timestamp', now)
+            pipe.get(INVENTORY_GENERATION)
+            return int(pipe.execute()[-1] or 0)
+
+        _, old_datasets = self.get_snapshot(*changed)
+        for name in names:
+            if name in changed:
+                value = datasets[name]
+                if name in ENTITY_INVENTORIES:
+                    self.set_inventory(name, value, pipe)
+                else:
+                    pipe.set(name, dumps(value))
+                if name == 'agents':
+                    self.set_heartbeats(value, pipe)
+                pipe.set(f'{name}:fingerprint', fingerprints[name])
+                project = EVENT_PROJECTIONS.get(name)
+                if project:
+                    event = diff_entities(
+                        project(old_datasets[name] or {}), project(value))
+                else:
+                    event = diff_entities(old_datasets[name], value)
+                if any(event.values()):
+                    self.add_event(name, event, pipe)
+            pipe.set(f'{name}:timestamp', now)
+
+        pipe.incr(INVENTORY_GENERATION)
+
+        return pipe.execute()[-1]
+
+    def get_snapshot(self, *names):
+        """
+        Read a consistent set of datasets in a single round trip. Returns
+        the snapshot generation and dict of decoded datasets.
+
+        With the in-process cache enabled, only fingerprints are read when
+        datasets have not changed since the last read. Cached datasets are
+        shared, callers must not modify them (use get for a private copy).
+        """
+        if self._cache is None or not names:
+            return self._read_snapshot(names)[:2]
+
+        pipe = self.pipeline()
+        pipe.get(INVENTORY_GENERATION)
+        for name in names:
+            pipe.get(f'{name}:fingerprint')
+        values = pipe.execute()
+
+        generation = int(values[0] or 0)
+        datasets = {}
+        for name, version in zip(names, values[1:]):
+            entry = self._cache.get(name, version) if version else None
+            if entry:
+                datasets[name] = entry[1]
+
+        stale = [name for name in names if name not in datasets]
+        if not stale:
+            return generation, datasets
+
+        fresh_generation, fresh, versions = self._read_snapshot(stale)
+        if fresh_generation != generation:
+            # snapshot published in between, read everything again
+            stale = names
+            generation, fresh, versions = self._read_snapshot(stale)
+
+        for name in stale:
+            datasets[name] = fresh[name]
+            version = versions[name]
+            if version:
+                self._cache.put(
+                    name, version, fresh[name], decoded_size(fresh[name]))
+            else:
+                self._cache.discard(name)
+
+        return generation, datasets
+
+    def _read_snapshot(self, names):
+        use_hash = INVENTORY_LAYOUT != 'blob'
+        pipe = self.pipeline()
+        pipe.get(INVENTORY_GENERATION)
+        for name in names:
+            pipe.get(f'{name}:fingerprint')
+            pipe.get(name)
+            if name in ENTITY_INVENTORIES and use_hash:
+                pipe.hgetall(f'{name}:hash')
+        values = iter(pipe.execute())
+
+        generation = int(next(values) or 0)
+        datasets, versions = {}, {}
+        for name in names:
+            version = next(values)
+            value = next(values)
+            versions[name] = version
+            if name in ENTITY_INVENTORIES and use_hash:
+                entities = next(values)
+                if entities or not value:
+                    datasets[name] = {
+                        k.decode('utf-8'): loads(v)
+                        for k, v in entities.items()
+                    }
+                    continue
+            if name in ENTITY_INVENTORIES:
+                datasets[name] = loads(value) if value else {}
+            else:
+                datasets[name] = loads(value) if value else None
+
+        return generation, datasets, versions
+
+    def set_servers(self, servers):
+        """
+        Store servers inventory together with hypervisor to instances index
+        holding compact projections of the servers.
+        """
+        servers_fingerprint = fingerprint(servers)
+        if self.get('servers:fingerprint', str) == servers_fingerprint:
+            return
+
+        old_hv = {
+            uuid.decode('utf-8'): hv.decode('utf-8')
+            for uuid, hv in self.hgetall(SERVERS_HV).items()
+        }
+
+        pipe = self.pipeline()
+        self.set_inventory('servers', servers, pipe)
+        pipe.set('servers:fingerprint', servers_fingerprint)
+        pipe.delete(SERVERS_HV, SERVERS_NAME, SERVERS_NAMES)
+        for hv in set(old_hv.values()):
+            pipe.delete(hv_instances_key(hv))
+
+        server_hv = {}
+        hv_instances = {}
+        for uuid, server in servers.items():
+            hv = server.get('hypervisor_hostname')
+            if hv:
+                server_hv[uuid] = hv
+                hv_instances.setdefault(hv, {})[uuid] = \
+                    dumps(hot_server(server))
+
+        if server_hv:
+            pipe.hmset(SERVERS_HV, server_hv)
+        for hv, instances in hv_instances.items():
+            pipe.hmset(hv_instances_key(hv), instances)
+        if servers:
+            pipe.hmset(SERVERS_NAME, {
+                uuid: server['name'] for uuid, server in servers.items()})
+            pipe.zadd(SERVERS_NAMES, {
+                f'{server["name"]}\0{uuid}': 0
+                for uuid, server in servers.items()})
+
+        self.add_event('servers', {
+            'added': [uuid for uuid in server_hv if uuid not in old_hv],
+            'removed': [uuid for uuid in old_hv if uuid not in server_hv],
+            'moved': {
+                uuid: [old_hv[uuid], hv] for uuid, hv in server_hv.items()
+                if uuid in old_hv and old_hv[uuid] != hv
+            },
+        }, pipe)
+        pipe.execute()
+
+    def stream_servers(self, servers, page_size=1000):
+        """
+        Store servers inventory from an iterable of server dicts page by
+        page, so the whole inventory is never held in memory. Pages are
+        written to staging keys of this run which replace the live ones in
+        a single transaction at the end. Staging keys expire, so the ones
+        left behind by an interrupted run are cleaned up by redis. Requires
+        hash inventory layout.
+        """
+        assert INVENTORY_LAYOUT == 'hash'
+
+        run_id = uuid4().hex
+        live_keys = ['servers:hash', SERVERS_HV, SERVERS_NAME, SERVERS_NAMES]
+
+        digest = hashlib.sha256()
+        written, new_hvs = set(), set()
+        added, moved = [], {}
+        servers = iter(servers)
+        while True:
+            page = list(islice(servers, page_size))
+            if not page:
+                break
+
+            uuids = [server['id'] for server in page]
+            old_hv = {
+                uuid: hv.decode('utf-8') if hv else None
+                for uuid, hv in zip(uuids, self.hmget(SERVERS_HV, uuids))
+            }
+
+            server_hv, hv_instances = {}, {}
+            for server in page:
+                uuid, hv = server['id'], server.get('hypervisor_hostname')
+                digest.update(json.dumps(
+                    server, sort_keys=True, default=str).encode('utf-8'))
+                if not hv:
+                    continue
+
+                server_hv[uuid] = hv
+                hv_instances.setdefault(hv, {})[uuid] = \
+                    dumps(hot_server(server))
+                if not old_hv[uuid]:
+                    added.append(uuid)
+                elif old_hv[uuid] != hv:
+                    moved[uuid] = [old_hv[uuid], hv]
+
+            pipe = self.pipeline(transaction=False)
+            pipe.hmset(staging_key('servers:hash', run_id), {
+                server['id']: dumps(server) for server in page})
+            pipe.hmset(staging_key(SERVERS_NAME, run_id), {
+                server['id']: server['name'] for server in page})
+            pipe.zadd(staging_key(SERVERS_NAMES, run_id), {
+                f'{server["name"]}\0{server["id"]}': 0 for server in page})
+            written.update(['servers:hash', SERVERS_NAME, SERVERS_NAMES])
+            if server_hv:
+                pipe.hmset(staging_key(SERVERS_HV, run_id), server_hv)
+                written.add(SERVERS_HV)
+            for hv, instances in hv_instances.items():
+                key = staging_key(hv_instances_key(hv), run_id)
+                pipe.hmset(key, instances)
+                pipe.expire(key, STAGING_TTL)
+            for key in written:
+                pipe.expire(staging_key(key, run_id), STAGING_TTL)
+            pipe.execute()
+            new_hvs.update(hv_instances)
+
+        staged = [staging_key(key, run_id) for key in written] + \
+            [staging_key(hv_instances_key(hv), run_id) for hv in new_hvs]
+
+        servers_fingerprint = digest.hexdigest()
+        if self.get('servers:fingerprint', str) == servers_fingerprint:
+            if staged:
+                self.delete(*staged)
+            return
+
+        with self.pipeline() as pipe:
+            while True:
+                try:
+                    # live servers replaced by an overlapping run or staged
+                    # keys expiring abort the swap
+                    pipe.watch(SERVERS_HV, *staged)
+                    if staged and pipe.exists(*staged) != len(staged):
+                        raise Exception(
+                            f'staged servers of run {run_id} expired')
+
+                    removed, old_hvs = [], set()
+                    cursor = None
+                    while cursor != 0:
+                        cursor, old_hv = pipe.hscan(
+                            SERVERS_HV, cursor or 0, count=page_size)
+                        uuids = list(old_hv)
+                        old_hvs.update(
+                            hv.decode('utf-8') for hv in old_hv.values())
+                        if uuids:
+                            staged_hv = pipe.hmget(
+                                staging_key(SERVERS_HV, run_id), uuids)
+                            removed.extend(
+                                uuid.decode('utf-8')
+                                for uuid, hv in zip(uuids, staged_hv)
+                                if hv is None)
+
+                    pipe.multi()
+                    for key in live_keys:
+                        if key in written:
+                            pipe.rename(staging_key(key, run_id), key)
+                        else:
+                            pipe.delete(key)
+                    for hv in old_hvs - new_hvs:
+                        pipe.delete(hv_instances_key(hv))
+                    for hv in new_hvs:
+                        key = hv_instances_key(hv)
+                        pipe.rename(staging_key(key, run_id), key)
+                    pipe.set('servers:fingerprint', servers_fingerprint)
+                    self.add_event('servers', {
+                        'added': added, 'removed': removed, 'moved': moved},
+                        pipe)
+                    pipe.execute()
+                    return
+                except WatchError:
+                    continue
+
+    def update_servers(self, servers, removed=None):
+        """
+        Update given servers (and remove removed ones) in servers inventory
+        and hypervisor to instances index.
+        """
+        removed = list(removed or [])
+        uuids = list(servers) + removed
+        if not uuids:
+            return
+
+        old_hv = {
+            uuid: hv.decode('utf-8')
+            for uuid, hv in zip(uuids, self.hmget(SERVERS_HV, uuids)) if hv
+        }
+        old_name = {
+            uuid: name.decode('utf-8')
+            for uuid, name in zip(uuids, self.hmget(SERVERS_NAME, uuids))
+            if name is not None
+        }
+
+        pipe = self.pipeline()
+        self.update_inventory('servers', servers, removed, pipe)
+        pipe.delete('servers:fingerprint')
+        for uuid in removed:
+            if uuid in old_hv:
+                pipe.hdel(hv_instances_key(old_hv[uuid]), uuid)
+                pipe.hdel(SERVERS_HV, uuid)
+
+        for uuid in uuids:
+            if uuid in old_name:
+                pipe.zrem(SERVERS_NAMES, f'{old_name[uuid]}\0{uuid}')
+        if removed:
+            pipe.hdel(SERVERS_NAME, *removed)
+        if servers:
+            pipe.hmset(SERVERS_NAME, {
+                uuid: server['name'] for uuid, server in servers.items()})
+            pipe.zadd(SERVERS_NAMES, {
+                f'{server["name"]}\0{uuid}': 0
+                for uuid, server in servers.items()})
+
+        for uuid, server in servers.items():
+            hv = server.get('hypervisor_hostname')
+            if uuid in old_hv and old_hv[uuid] != hv:
+                pipe.hdel(hv_instances_key(old_hv[uuid]), uuid)
+            if hv:
+                pipe.hset(SERVERS_HV, uuid, hv)
+                pipe.hset(hv_instances_key(hv), uuid,
+                          dumps(hot_server(server)))
+            else:
+                pipe.hdel(SERVERS_HV, uuid)
+
+        self.add_event('servers', {
+            'added': [uuid for uuid in servers if uuid not in old_name],
+            'removed': removed,
+            'moved': {
+                uuid: [old_hv[uuid], server.get('hypervisor_hostname')]
+                for uuid, server in servers.items()
+                if uuid in old_hv and
+                old_hv[uuid] != server.get('hypervisor_hostname')
+            },
+            'updated': [uuid for uuid in servers if uuid in old_name],
+        }, pipe)
+        pipe.execute()
+
+    def get_hypervisor_instances(self, hv):
+        """
+        Get compact projections of instances running on hypervisor as dict
+        of uuid to projection. Falls back to scanning servers inventory when
+        the index has not been written yet.
+        """
+        instances = self.hgetall(hv_instances_key(hv))
+        if instances or self.exists(SERVERS_HV):
+            return {
+                k.decode('utf-8'): loads(v)
+                for k, v in instances.items()
+            }
+
+        return {
+            uuid: hot_server(server)
+            for uuid, server in self.get_servers().items()
+            if server.get('hypervisor_hostname') == hv
+        }
+
+    def get_entities(self, name, keys=None):
+        """
+        Get entities of the inventory stored under name. Only the requested
+        keys are fetched from the hash layout, the whole inventory is
+        returned when keys are not given. Falls back to the blob layout when
+        the hash has not been written yet, entities read from there may be
+        shared with the in-process cache and must not be modified.
+        """
+        if keys is not None:
+            keys = list(keys)
+            if not keys:
+                return {}
+
+        if INVENTORY_LAYOUT != 'blob':
+            hash_name = f'{name}:hash'
+            if keys is None:
+                values = self.hgetall(hash_name)
+                entities = {
+                    k.decode('utf-8'): loads(v)
+                    for k, v in values.items()
+                }
+            else:
+                values = self.hmget(hash_name, keys)
+                entities = {
+                    k: loads(v)
+                    for k, v in zip(keys, values) if v is not None
+                }
+
+            if entities or self.exists(hash_name):
+                return entities
+
+        entities = self.get(name, loads) or {}
+        if keys is None:
+            return entities
+
+        return {k: entities[k] for k in keys if k in entities}
+
+    def get_entity(self, name, key):
+        return self.get_entities(name, [key]).get(key)
+
+    def get_servers(self, uuids=None):
+        return self.get_entities('servers', uuids)
+
+    def get_server(self, uuid):
+        return self.get_entity('servers', uuid)
+
+    def get_hypervisors(self, names=None):
+        return self.get_entities('hypervisors', names)
+
+    def get_hypervisor(self, name):
+        return self.get_entity('hypervisors', name)
+
+    def set_last_seen(self, hosts, timestamp):
+        """
+        Record hosts seen up by the prober sweep started at timestamp.
+        """
+        with self.pipeline() as pipe:
+            if hosts:
+                pipe.zadd(HVS_LAST_SEEN, {host: timestamp for host in hosts})
+            pipe.set(HVS_PROBE_TIMESTAMP, timestamp)
+            pipe.execute()
+
+    def get_unseen(self, hosts, since):
+        """
+        Return hosts the latest prober sweep has not seen up. Returns None
+        when the latest sweep started before the given timestamp.
+        """
+        probe_timestamp = self.get(HVS_PROBE_TIMESTAMP, float)
+        if probe_timestamp is None or probe_timestamp < since:
+            return None
+
+        with self.pipeline() as pipe:
+            for host in hosts:
+                pipe.zscore(HVS_LAST_SEEN, host)
+            scores = pipe.execute()
+
+        return [
+            host for host, score in zip(hosts, scores)
+            if score is None or score < probe_timestamp
+        ]
+
+    def set_heartbeats(self, agents, pipe=None):
+        """
+        Replace index of the newest agent heartbeat per host. Agents are
+        given as dict of host to dict of agent binary to epoch heartbeat.
+        """
+        heartbeats = {
+            host: max(agent_dict.values())
+            for host, agent_dict in agents.items() if agent_dict
+        }
+        p = pipe or self.pipeline()
+        p.delete(AGENTS_HEARTBEAT)
+        if heartbeats:
+            p.zadd(AGENTS_HEARTBEAT, heartbeats)
+        if not pipe:
+            p.execute()
+
+    def get_stale_hosts(self, since):
+        """
+        Return dict of hosts whose newest agent heartbeat is older than
+        since (epoch) to that heartbeat.
+        """
+        entries = self.zrangebyscore(
+            AGENTS_HEARTBEAT, '-inf', f'({since}', withscores=True)
+
+        return {host.decode('utf-8'): ts for host, ts in entries}
+
+    def set_spare_pool(self, services, aggregates, hypervisors):
+        """
+        Rebuild index of spare hypervisors: one sorted set of free spares
+        scored by vcpus per zone and aggregate, and capacity profile of
+        every compute host. Spares claimed recently are left out.
+        """
+        profiles, pools = {}, {}
+        for host, service in services.items():
+            hv = hypervisors.get(host)
+            if not hv:
+                continue
+
+            profile = {
+                'zone': service['zone'],
+                'aggregate': aggregates.get(host),
+                'vcpus': hv['vcpus'],
+                'vcpus_used': hv['vcpus_used'],
+            }
+            profiles[host] = json.dumps(profile)
+            if is_spare(service, hv):
+                key = spare_pool_key(profile['zone'], profile['aggregate'])
+                pools.setdefault(key, {})[host] = hv['vcpus']
+
+        spares = [host for pool in pools.values() for host in pool]
+        with self.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(SPARE_POOLS, *pools)
+                    old_pools = pipe.smembers(SPARE_POOLS)
+                    if old_pools:
+                        pipe.watch(*old_pools)
+                    claims = self.mget(
+                        [spare_claim_key(host) for host in spares]) \
+                        if spares else []
+                    claimed = {
+                        host for host, claim in zip(spares, claims) if claim
+                    }
+
+                    pipe.multi()
+                    pipe.delete(SPARE_PROFILES, SPARE_POOLS, *old_pools)
+                    if profiles:
+                        pipe.hmset(SPARE_PROFILES, profiles)
+                    for key, pool in pools.items():
+                        free = {
+                            host: vcpus for host, vcpus in pool.items()
+                            if host not in claimed
+                        }
+                        if free:
+                            pipe.zadd(key, free)
+                            pipe.sadd(SPARE_POOLS, key)
+                    pipe.execute()
+                    return
+                except WatchError:
+                    continue
+
+    def claim_spares(self, hosts, ttl=SPARE_CLAIM_TTL):
+        """
+        Atomically claim best-fit spares for all hosts from the spare index.
+        Largest hosts are served first, each one gets the smallest free
+        spare in its zone and aggregate with enough vcpus. Nothing is
+        claimed unless every host gets a spare.
+
+        Returns dict of host to spare (None when no spare fits) or None when
+        the spare index has not been built yet.
+        """
+        hosts = list(hosts)
+        if not self.exists(SPARE_PROFILES):
+            return None
+        if not hosts:
+            return {}
+
+        profiles = {
+            host: json.loads(profile)
+            for host, profile in zip(
+                hosts, self.hmget(SPARE_PROFILES, hosts)) if profile
+        }
+        pool_keys = {
+            host: spare_pool_key(profile['zone'], profile['aggregate'])
+            for host, profile in profiles.items()
+        }
+        by_size = sorted(
+            pool_keys, key=lambda host: profiles[host]['vcpus'], reverse=True)
+
+        with self.pipeline() as pipe:
+            while True:
+                try:
+                    keys = set(pool_keys.values())
+                    if keys:
+                        pipe.watch(*keys)
+                    pools = {
+                        key: pipe.zrange(key, 0, -1, withscores=True)
+                        for key in keys
+                    }
+
+                    allocation = dict.fromkeys(hosts)
+                    for host in by_size:
+                        for spare, vcpus in pools[pool_keys[host]]:
+                            spare = spare.decode('utf-8')
+                            if spare in allocation.values() or \
+                               vcpus < profiles[host]['vcpus']:
+                                continue
+                            allocation[host] = spare
+                            break
+
+                    if not all(allocation.values()):
+                        return allocation
+
+                    pipe.multi()
+                    for host, spare in allocation.items():
+                        pipe.zrem(pool_keys[host], spare)
+                        pipe.set(spare_claim_key(spare), host, ex=ttl)
+                    pipe.execute()
+                    return allocation
+                except WatchError:
+                    continue
+
+    def take_token(self, name, rate, capacity):
+        """
+        Take one token from bucket shared by all processes, refilled with
+        rate tokens per second up to capacity. Returns 0 when the token was
+        taken or number of seconds to wait for the next one.
+        """
+        with self.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(name)
+                    tokens, updated = pipe.hmget(name, 'tokens', 'timestamp')
+                    seconds, microseconds = pipe.time()
+                    now = seconds + microseconds / 1e6
+
+                    tokens = capacity if tokens is None else float(tokens)
+                    if updated is not None:
+                        tokens = min(
+                            capacity, tokens + (now - float(updated)) * rate)
+                    if tokens < 1:
+                        return (1 - tokens) / rate
+
+                    pipe.multi()
+                    pipe.hmset(name, {'tokens': tokens - 1, 'timestamp': now})
+                    pipe.execute()
+                    return 0
+                except WatchError:
+                    continue
+
+    def signal_job(self, job_id):
+        """
+        Signal that job is done (finished or failed) to waiting monitor.
+        """
+        key = job_signal_key(job_id)
+        with self.pipeline() as pipe:
+            pipe.rpush(key, job_id)
+            pipe.expire(key, JOB_SIGNAL_TTL)
+            pipe.execute()
+
+    def wait_job_signal(self, job_ids, timeout):
+        """
+        Block until any of the jobs signals it is done and return its id.
+        Returns None when no job is done within timeout seconds.
+        """
+        keys = [job_signal_key(job_id) for job_id in job_ids]
+        entry = self.blpop(keys, max(1, math.ceil(timeout)))
+        if entry:
+            return entry[1].decode('utf-8')
+
+        return None
+
+    def find_servers(self, prefix, exact=False, limit=10):
+        """
+        Find servers by name (or name prefix) and return dict of uuid to
+        name. Returns None when the name index has not been written yet.
+        """
+        if not self.exists(SERVERS_NAME):
+            return None
+
+        start = (prefix + '\0' if exact else prefix).encode('utf-8')
+        entries = self.zrangebylex(
+            SERVERS_NAMES, b'[' + start, b'[' + start + b'\xff', 0, limit)
+        servers = {}
+        for entry in entries:
+            name, uuid = entry.decode('utf-8').rsplit('\0', 1)
+            servers[uuid] = name
+
+        return servers
+
     def show(self, command):
         cmds = command.split(' ')
 
@@ -73,16 +1012,34 @@ class SonnyRedis(StrictRedis):
             if hv.startswith('<') and hv.endswith('>') and '|' in hv:
                 hv = hv.strip('<>').split('|')[1]
 
-            hvs = self.get('hypervisors', json.loads)
-            if hv in hvs:
-                return yaml.dump(hvs[hv])
+            hv_r = self.get_hypervisor(hv)
+            if hv_r:
+                return yaml.dump(hv_r)
 
         elif cmds[1] == 'vm':
             vm = cmds[2]
-            vms = self.get('servers', json.loads)
+            vm_r = self.get_server(vm)
+            if vm_r:
+                return yaml.dump(vm_r)
 
-            for uuid, v in vms.items():
-                if uuid == vm or v['name'] == vm:
-                    return yaml.dump(v)
+            found = self.find_servers(vm, exact=True, limit=1)
+            if found is None:
+                for _, v in self.get_servers().items():
+                    if v['name'] == vm:
+                        return yaml.dump(v)
+            elif found:
+                return yaml.dump(self.get_server(next(iter(found))))
 
         return None
+
+    def show_matches(self, command, limit=10):
+        """
+        Return sorted list of "name (uuid)" of servers whose name starts
+        with the name in show vm command. Meant for when no cloud has exact
+        match for the command.
+        """
+        cmds = command.split(' ')
+        found = self.find_servers(cmds[2], limit=limit) \
+            if cmds[1] == 'vm' else None
+
+        return sorted(f'{n} ({u})' for u, n in (found or {}).items())
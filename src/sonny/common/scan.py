@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    Sonny
+#
+#    Copyright (C) 2018  Marko Kosmerl
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import division, print_function, absolute_import
+
+import asyncio
+
+from sonny.common.config import (
+    SCAN_CONCURRENCY,
+    SCAN_RETRIES,
+    SCAN_TIMEOUT
+)
+
+__author__ = "Marko Kosmerl"
+__copyright__ = "Marko Kosmerl"
+__license__ = "gpl3"
+
+# ports checked to tell whether hypervisor is up
+HV_PORTS = [22, 111, 16509]
+# ports unprivileged nmap host discovery connects to, a host answering
+# on any of them is up even when all scanned ports are filtered
+DISCOVERY_PORTS = [80, 443]
+
+
+async def probe(host, port, timeout, retries):
+    """
+    TCP connect probe. Host is considered up when it accepts or refuses
+    the connection, like it is by nmap.
+    """
+    for _ in range(retries + 1):
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), timeout)
+            writer.close()
+            return True
+        except ConnectionRefusedError:
+            return True
+        except (asyncio.TimeoutError, OSError):
+            continue
+
+    return False
+
+
+async def probe_host(host, port_list, semaphore, timeout, retries):
+    """
+    Probe scanned ports and then nmap host discovery ports, host is up
+    when any of them answers.
+    """
+    discovery_ports = [p for p in DISCOVERY_PORTS if p not in port_list]
+    for port in list(port_list) + discovery_ports:
+        async with semaphore:
+            if await probe(host, port, timeout, retries):
+                return host
+
+    return None
+
+
+async def async_tcp_scan(host_list, port_list, concurrency=None,
+                         timeout=None, retries=None, first=False):
+    concurrency = concurrency or SCAN_CONCURRENCY
+    timeout = timeout or SCAN_TIMEOUT
+    retries = SCAN_RETRIES if retries is None else retries
+
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [
+        asyncio.ensure_future(
+            probe_host(host, port_list, semaphore, timeout, retries))
+        for host in host_list
+    ]
+
+    up_hosts = set()
+    try:
+        for task in asyncio.as_completed(tasks):
+            host = await task
+            if host:
+                up_hosts.add(host)
+                if first:
+                    break
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return up_hosts
+
+
+def tcp_scan(host_list, port_list, **kwargs):
+    """
+    Scan hosts with TCP connect on given ports and return set of hosts
+    that are up. Like nmap, hosts answering on host discovery ports are up
+    too. With first=True the scan stops at the first host up.
+    """
+    return asyncio.run(async_tcp_scan(host_list, port_list, **kwargs))
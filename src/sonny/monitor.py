@@ -21,99 +21,159 @@
 from __future__ import division, print_function, absolute_import
 
 import argparse
-import datetime
-import json
+import asyncio
+import math
 import signal
 import sys
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from rq import Queue
 
 from sonny import __version__
-from sonny.ns4 import (
-    nmap_scan,
-    refresh_redis_inventory,
-    resurrect_instances)
 from sonny.common.config import (
+    AGENTS_PERIOD,
     COOLDOWN_PERIOD,
     DEAD_BACKOFF,
     HEARTBEAT_PERIOD,
+    INSTANCE_PROBE,
+    MONITOR_CADENCE,
+    MONITOR_CALM_STEPS,
+    MONITOR_MAX_PERIOD,
+    MONITOR_MIN_PERIOD,
+    MONITOR_MODE,
     MONITOR_PERIOD,
+    PROBE_MAX_AGE,
+    RECOVERY_MIN_RATE,
+    RECOVERY_RATE,
+    SCAN_MAX_JOBS,
+    SCAN_SHARD_SIZE,
     SUSPICIOUS_BACKOFF
 )
 from sonny.common.config import (
     CLOUD,
-    EXT_NET_LIST,
+    MONITOR_CLOUDS,
     SLACK_TOKEN,
     SLACK_CHANNEL
 )
 from sonny.common.redis import SonnyRedis
-
-assert CLOUD is not None
-
-strptime = datetime.datetime.strptime
-utcnow = datetime.datetime.utcnow
+from sonny.common.scan import HV_PORTS
 
 _logger = logging.getLogger(__name__)
 
-# REDIS
-redis = SonnyRedis(CLOUD)
-work_queue = Queue(connection=redis)
+# seconds to wait for job signal before checking status of all jobs
+JOB_SIGNAL_TIMEOUT = 5
+# seconds resurrection job may take besides rate limited reboots
+RESURRECT_TIMEOUT = 600
 
 
 class SonnyHandler(logging.StreamHandler):
 
-    def __init__(self, topic):
+    def __init__(self, topic, redis):
         logging.StreamHandler.__init__(self)
         self.topic = topic
+        self.redis = redis
 
     def emit(self, record):
         msg = self.format(record)
-        redis.publish(self.topic, msg)
+        self.redis.publish(self.topic, msg)
+
+
+class JobGroup:
+    """
+    Scan jobs of one host list split into shards, exposing the same
+    interface as a single job with merged result.
+    """
+
+    def __init__(self, jobs, host_list, port_list):
+        self.jobs = jobs
+        self.id = '+'.join(job.id for job in jobs)
+        self.args = (host_list, port_list)
+
+    @property
+    def job_ids(self):
+        return [job.id for job in self.jobs]
+
+    @property
+    def is_finished(self):
+        return all(job.is_finished for job in self.jobs)
+
+    @property
+    def is_failed(self):
+        return any(job.is_failed for job in self.jobs)
+
+    @property
+    def result(self):
+        if not self.is_finished:
+            return None
+
+        return [host for job in self.jobs for host in job.result]
+
+    @property
+    def exc_info(self):
+        return '\n'.join(
+            job.exc_info for job in self.jobs
+            if job.is_failed and job.exc_info)
+
+    def refresh(self):
+        for job in self.jobs:
+            job.refresh()
 
 
 class Monitor:
 
-    def __init__(self):
-        work_queue.empty()
-        for key in redis.keys('rq:job:*'):
-            redis.delete(key)
+    def __init__(self, cloud=CLOUD):
+        self.cloud = cloud
+        self.logger = logging.getLogger(f'{__name__}.{cloud}')
+        self.redis = SonnyRedis(cloud)
+        self.work_queue = Queue(connection=self.redis)
+        # queue for short jobs that should not wait behind inventory refresh
+        self.fast_queue = Queue('fast', connection=self.redis)
+
+        self.work_queue.empty()
+        self.fast_queue.empty()
+        for key in self.redis.keys('rq:job:*'):
+            self.redis.delete(key)
 
         if SLACK_TOKEN and SLACK_CHANNEL:
-            sonny_handler = SonnyHandler(CLOUD)
-            _logger.addHandler(sonny_handler)
+            sonny_handler = SonnyHandler(cloud, self.redis)
+            self.logger.addHandler(sonny_handler)
         else:
-            _logger.info('slack config missing')
+            self.logger.info('slack config missing')
 
-        _logger.info(f'monitor initialized on db {redis.db}')
+        self.logger.info(f'monitor initialized on db {self.redis.db}')
         signal.signal(signal.SIGINT, self.signal_catch)
         signal.signal(signal.SIGTERM, self.signal_catch)
 
         self.last_run_backed_off = 0
+        self.inventory_job = None
+        self.inventory_time = 0
+        self.fast_cycle = False
+        self.healthy_steps = 0
 
     def signal_catch(self, signum, frame):
-        _logger.warning('monitor terminating')
+        self.logger.warning('monitor terminating')
         sys.exit()
 
     @property
     def api_alive(self):
-        alive = redis.get('api_alive', int)
-        alive_ts = redis.get('api_alive:timestamp', float)
+        alive = self.redis.get('api_alive', int)
+        alive_ts = self.redis.get('api_alive:timestamp', float)
 
         return int(alive == 1 and (time.time() - alive_ts) < 60)
 
     @api_alive.setter
     def api_alive(self, alive=1):
-        redis.set('api_alive', alive)
+        self.redis.set('api_alive', alive)
         if alive:
-            redis.set('api_alive:timestamp', time.time())
+            self.redis.set('api_alive:timestamp', time.time())
 
     def run(self):
         def period_sleep(check_time):
-            time.sleep(max(MONITOR_PERIOD - (time.time() - check_time), 0))
+            time.sleep(max(self.period - (time.time() - check_time), 0))
 
-        _logger.info('monitor running')
+        self.logger.info('monitor running')
         self.api_alive = 1
 
         while True:
@@ -121,6 +181,54 @@ class Monitor:
             self.run_step()
             period_sleep(check_time)
 
+    @property
+    def period(self):
+        if MONITOR_CADENCE == 'adaptive':
+            return MONITOR_MIN_PERIOD if self.fast_cycle \
+                else MONITOR_MAX_PERIOD
+        elif MONITOR_MODE == 'pipelined':
+            return AGENTS_PERIOD
+
+        return MONITOR_PERIOD
+
+    def update_cadence(self, healthy):
+        """
+        Switch to fast cycle as soon as check is not healthy and back to
+        slow cycle after MONITOR_CALM_STEPS consecutive healthy checks.
+        """
+        if MONITOR_CADENCE != 'adaptive':
+            return
+
+        if not healthy:
+            if not self.fast_cycle:
+                self.logger.info('switching to fast cycle')
+            self.fast_cycle = True
+            self.healthy_steps = 0
+        elif self.fast_cycle:
+            self.healthy_steps += 1
+            if self.healthy_steps >= MONITOR_CALM_STEPS:
+                self.logger.info('switching to slow cycle')
+                self.fast_cycle = False
+
+    async def run_async(self, executor):
+        """
+        Run monitor on asyncio event loop, blocking steps run in executor
+        shared by monitors of all clouds.
+        """
+        loop = asyncio.get_event_loop()
+        self.logger.info('monitor running')
+        await loop.run_in_executor(executor, setattr, self, 'api_alive', 1)
+
+        while True:
+            check_time = time.time()
+            try:
+                await loop.run_in_executor(executor, self.run_step)
+            except Exception:
+                self.logger.exception('monitor step failed')
+
+            await asyncio.sleep(
+                max(self.period - (time.time() - check_time), 0))
+
     def run_step(self):
         """
         * update redis db,
@@ -129,105 +237,105 @@ class Monitor:
         * inspect instances if hypervisor is unresponsive
         * handle dead hypervisor if instances unresponsive
         """
-        _logger.debug('refreshing redis inventory')
-        job = self.refresh_redis_inventory()
+        self.logger.debug('refreshing redis inventory')
+        if MONITOR_MODE == 'pipelined' or self.fast_cycle:
+            job = self.refresh_pipelined()
+        else:
+            job = self.refresh_redis_inventory()
         job_finished = self.wait_for_job(job, 90)
 
         if job_finished and self.api_alive:
-            _logger.debug('openstack api available')
+            self.logger.debug('openstack api available')
 
             s_hvs = self.get_suspicious_hypervisors()
+            self.update_cadence(not s_hvs)
             if s_hvs:
                 backoff = len(s_hvs) > SUSPICIOUS_BACKOFF
                 if backoff and self.last_run_backed_off:
                     self.last_run_backed_off += 1
                     return
 
-                _logger.warning(f'suspicious hypervisors: {s_hvs}')
+                self.logger.warning(f'suspicious hypervisors: {s_hvs}')
                 if backoff:
                     self.last_run_backed_off += 1
-                    _logger.warning(
+                    self.logger.warning(
                         'too many suspicious hypervisors, backing off')
                     return
 
-                _logger.warning('scan check on on port 22, 111 and 16509')
+                self.logger.warning('scan check on on port 22, 111 and 16509')
                 done, u_hvs = self.inspect_hypervisors(s_hvs)
                 if done and u_hvs:
-                    _logger.warning(f'no response from {u_hvs}')
+                    self.logger.warning(f'no response from {u_hvs}')
 
                     d_hvs, a_hvs = self.inspect_instances(u_hvs)
                     if d_hvs:
-                        _logger.warning(f'dead hypervisors detected: {d_hvs}')
+                        self.logger.warning(
+                            f'dead hypervisors detected: {d_hvs}')
                         s_cnt, f_cnt = self.handle_dead_hypervisors(d_hvs)
                         if s_cnt and not f_cnt:
-                            _logger.info('affected instances resurrected')
+                            self.logger.info('affected instances resurrected')
 
                     if a_hvs:
-                        _logger.warning(f'some or all instances reachable '
-                                        f'but hypervisor is not: {a_hvs}')
+                        self.logger.warning(
+                            f'some or all instances reachable '
+                            f'but hypervisor is not: {a_hvs}')
                 else:
-                    _logger.info('tcp scan check shows hypervisors are ok')
+                    self.logger.info('tcp scan check shows hypervisors are ok')
             else:
                 if self.last_run_backed_off:
                     n = self.last_run_backed_off
-                    _logger.info('no suspicious hypervisors')
-                    _logger.info(f'backed off {n} times')
+                    self.logger.info('no suspicious hypervisors')
+                    self.logger.info(f'backed off {n} times')
                     self.last_run_backed_off = 0
                 else:
-                    _logger.debug('no suspicious hypervisors')
+                    self.logger.debug('no suspicious hypervisors')
         elif not self.api_alive:
             if job.result:
-                _logger.warning(f'issues within the worker: {job.result}')
+                self.logger.warning(f'issues within the worker: {job.result}')
             else:
-                _logger.warning(f'unknown issues with ns4')
+                self.logger.warning(f'unknown issues with ns4')
 
     def handle_dead_hypervisors(self, dead_hvs):
         dead_count = len(dead_hvs)
         if dead_count > DEAD_BACKOFF:
             if DEAD_BACKOFF == 0:
-                _logger.warning('running in dry mode')
+                self.logger.warning('running in dry mode')
             else:
-                _logger.warning(f'dead limit ({dead_count} > {DEAD_BACKOFF})')
-            _logger.warning('not performing any action')
+                self.logger.warning(
+                    f'dead limit ({dead_count} > {DEAD_BACKOFF})')
+            self.logger.warning('not performing any action')
             return None, None
 
-        last_resurrection = redis.get('resurrection:timestamp', float)
+        last_resurrection = self.redis.get('resurrection:timestamp', float)
         if last_resurrection and \
            time.time() - last_resurrection < COOLDOWN_PERIOD:
-            _logger.warning('cooldown period still active')
-            _logger.warning('not performing any action')
+            self.logger.warning('cooldown period still active')
+            self.logger.warning('not performing any action')
+            return None, None
+
+        spare_hvs = self.allocate_spare_hypervisors(dead_hvs)
+        if not all(spare_hvs.values()):
+            self.logger.warning(f'no spare hypervisors!')
             return None, None
 
         running_job = {}
-        selected_hv_set = set()
-        for dead_hv in dead_hvs:
-            spare_hv = self.get_spare_hypervisor(dead_hv, selected_hv_set)
-            if spare_hv:
-                selected_hv_set.add(spare_hv)
-                _logger.info(f'resurrection started: {dead_hv} -> {spare_hv}')
-                job = self.resurrect_instances(dead_hv, spare_hv)
-                running_job[job.id] = job
-            else:
-                _logger.warning(f'no spare hypervisors!')
-                return None, None
+        for dead_hv, spare_hv in spare_hvs.items():
+            self.logger.info(f'resurrection started: {dead_hv} -> {spare_hv}')
+            job = self.resurrect_instances(dead_hv, spare_hv)
+            running_job[job.id] = job
 
-        redis.set('resurrection:timestamp', time.time())
+        self.redis.set('resurrection:timestamp', time.time())
         success_count = failure_count = 0
-        while running_job:
-            time.sleep(2)
-
-            for job_id, job in dict(running_job).items():
-                dead_hv, spare_hv = job.args
-                if job.is_finished:
-                    _logger.info(f'success: {dead_hv} -> {spare_hv}')
-                    del running_job[job.id]
-                    success_count += 1
-                elif job.is_failed:
-                    job.refresh()
-                    _logger.warning(f'failure: {dead_hv} -> {spare_hv}')
-                    _logger.error(job.exc_info)
-                    del running_job[job.id]
-                    failure_count += 1
+        for job in self.wait_for_jobs(running_job.values()):
+            dead_hv, spare_hv = job.args
+            if job.is_finished:
+                self.logger.info(f'success: {dead_hv} -> {spare_hv}')
+                success_count += 1
+            else:
+                job.refresh()
+                self.logger.warning(f'failure: {dead_hv} -> {spare_hv}')
+                self.logger.error(job.exc_info)
+                failure_count += 1
 
         return success_count, failure_count
 
@@ -235,7 +343,12 @@ class Monitor:
         assert isinstance(suspicious_hvs, list)
         assert len(suspicious_hvs) > 0
 
-        job = self.inspect_hosts(suspicious_hvs, port_list=[22, 111, 16509])
+        since = time.time() - PROBE_MAX_AGE
+        unseen_hvs = self.redis.get_unseen(suspicious_hvs, since)
+        if unseen_hvs is not None:
+            return True, unseen_hvs
+
+        job = self.inspect_hosts(suspicious_hvs, port_list=HV_PORTS)
         if self.wait_for_job(job, 60):
             return True, job.result
 
@@ -255,49 +368,86 @@ class Monitor:
             instances = self.get_instances(hv)
             instances_ip = [ip for _, ip in instances]
             if not instances_ip:
-                _logger.info(f'no instances on {hv}')
+                self.logger.info(f'no instances on {hv}')
                 continue
 
-            _logger.info(f'inspecting instances {instances_ip}')
-            job = self.inspect_hosts(instances_ip, port_list=[22])
+            self.logger.info(f'inspecting instances {instances_ip}')
+            if INSTANCE_PROBE == 'sample':
+                job = self.probe_instances(instances_ip)
+            else:
+                job = self.inspect_hosts(instances_ip, port_list=[22])
             job.hv = hv
             running_job[job.id] = job
 
-        while running_job:
-            time.sleep(1)
-
-            for job_id, job in dict(running_job).items():
-                if job.is_finished:
-                    all_ips = job.args[0]
-                    dead_ips = job.result
-                    if len(dead_ips) == len(all_ips):
-                        dead_hvs.append(job.hv)
-                    else:
-                        alive_hvs.append(job.hv)
-                    del running_job[job.id]
-                elif job.is_failed:
-                    alive_hvs.append(job.hv)
-                    del running_job[job.id]
+        for job in self.wait_for_jobs(running_job.values()):
+            if not job.is_finished:
+                alive_hvs.append(job.hv)
+                continue
+
+            if INSTANCE_PROBE == 'sample':
+                all_dead = not job.result
+            else:
+                all_dead = len(job.result) == len(job.args[0])
+
+            if all_dead:
+                dead_hvs.append(job.hv)
+            else:
+                alive_hvs.append(job.hv)
 
         return dead_hvs, alive_hvs
 
     def wait_for_job(self, job, timeout=30):
-        start_time = time.time()
-        while not (job.is_finished or job.is_failed):
-            time.sleep(1)
-            if time.time() - start_time > timeout:
-                return False
+        for _ in self.wait_for_jobs([job], timeout):
+            pass
 
         return job.is_finished
 
+    def wait_for_jobs(self, jobs, timeout=None):
+        """
+        Yield jobs as they finish or fail. Wakes up on completion signals
+        from ns4 workers and checks all jobs every JOB_SIGNAL_TIMEOUT
+        seconds in case a signal is missing. Stops after timeout seconds
+        when given.
+        """
+        pending = list(jobs)
+        deadline = time.time() + timeout if timeout is not None else None
+        check_jobs = pending
+
+        while pending:
+            for job in list(check_jobs):
+                if job.is_finished or job.is_failed:
+                    pending.remove(job)
+                    yield job
+
+            if not pending:
+                break
+
+            wait = JOB_SIGNAL_TIMEOUT
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    break
+
+            job_ids = {
+                job_id: job for job in pending
+                for job_id in (job.job_ids if isinstance(job, JobGroup)
+                               else [job.id])
+            }
+            signaled_id = self.redis.wait_job_signal(list(job_ids), wait)
+            check_jobs = [job_ids[signaled_id]] if signaled_id else pending
+
     def get_suspicious_hypervisors(self):
-        _logger.debug('checking for suspicious hypervisors')
-        current_time = utcnow().timestamp()
-        agents = redis.get('agents', json.loads)
-        hvs = redis.get('hypervisors', json.loads)
+        self.logger.debug('checking for suspicious hypervisors')
+        current_time = time.time()
+        stale_hosts = self.redis.get_stale_hosts(
+            current_time - HEARTBEAT_PERIOD)
+        if not stale_hosts:
+            return []
+
+        hvs = self.redis.get_hypervisors(stale_hosts)
         hypervisor_list = []
 
-        for hv_name, agent_dict in agents.items():
+        for hv_name, heartbeat in stale_hosts.items():
             if hv_name not in hvs:
                 continue
 
@@ -305,62 +455,71 @@ class Monitor:
             if hv['state'] == 'down' and \
                hv['service_details']['disabled_reason'] and \
                'sonny' in hv['service_details']['disabled_reason']:
-                _logger.debug(f'{hv_name} is down but alredy handled')
+                self.logger.debug(f'{hv_name} is down but alredy handled')
                 continue
             elif hv['status'] == 'disabled' and hv['running_vms'] == 0:
-                _logger.debug(
+                self.logger.debug(
                     f'ignoring {hv_name} (disabled and 0 running vms)')
                 continue
             elif hv['status'] == 'disabled' and hv['running_vms'] > 0:
                 r_vms = hv['running_vms']
-                _logger.warning(
+                self.logger.warning(
                     f'{hv_name} is disabled and running {r_vms} instances!')
             elif hv['running_vms'] == 0:
-                _logger.debug(f'ignoring {hv_name} (0 running vms)')
+                self.logger.debug(f'ignoring {hv_name} (0 running vms)')
                 continue
 
-            ts_list = [
-                strptime(t, "%Y-%m-%d %H:%M:%S").timestamp()
-                for t in agent_dict.values()
-            ]
-
-            if all([(current_time - t) > HEARTBEAT_PERIOD for t in ts_list]):
-                hypervisor_list.append(hv_name)
-                _logger.debug(f'hypervisor {hv_name} is suspicious')
-                for a, t in agent_dict.items():
-                    tt = strptime(t, "%Y-%m-%d %H:%M:%S").timestamp()
-                    tt_d = int(current_time - tt)
-                    _logger.debug(f'last heartbeat of {a} was {tt_d} sec ago')
+            hypervisor_list.append(hv_name)
+            self.logger.debug(f'hypervisor {hv_name} is suspicious')
+            heartbeat_age = int(current_time - heartbeat)
+            self.logger.debug(f'last heartbeat was {heartbeat_age} sec ago')
 
         return hypervisor_list
 
     def get_instances(self, hypervisor):
-        _logger.debug(f'checking for affected instances on {hypervisor}')
-        servers = redis.get('servers', json.loads)
-        instance_list = []
+        self.logger.debug(f'checking for affected instances on {hypervisor}')
+        instances = self.redis.get_hypervisor_instances(hypervisor)
 
-        for _, server in servers.items():
-            if server['hypervisor_hostname'] == hypervisor:
-                for net in EXT_NET_LIST:
-                    if net in server['addresses']:
-                        instance_name = server['name']
-                        instance_ip = server['addresses']['ext-net'][0]['addr']
-                        instance_list.append((instance_name, instance_ip))
+        return [
+            (instance['name'], ip)
+            for instance in instances.values() for ip in instance['ips']
+        ]
 
-        return instance_list
+    def allocate_spare_hypervisors(self, dead_hvs):
+        """
+        Claim spare hypervisor for each dead one in a single atomic step
+        from the spare index, falling back to scanning inventory when the
+        index has not been built yet. Returns dict of dead hypervisor to
+        spare hypervisor (None when no spare fits).
+        """
+        spare_hvs = self.redis.claim_spares(dead_hvs)
+        if spare_hvs is not None:
+            return spare_hvs
+
+        spare_hvs = {}
+        for dead_hv in dead_hvs:
+            spare_hv = self.get_spare_hypervisor(
+                dead_hv, set(spare_hvs.values()))
+            spare_hvs[dead_hv] = spare_hv
+            if not spare_hv:
+                break
+
+        return spare_hvs
 
     def get_spare_hypervisor(self, hv_down, ignore_set={}):
-        _logger.info(f'getting spare hypervisor for {hv_down}')
+        self.logger.info(f'getting spare hypervisor for {hv_down}')
 
-        services = redis.get('services', json.loads)
-        aggregates = redis.get('aggregates', json.loads)
-        hypervisors = redis.get('hypervisors', json.loads)
+        _, snapshot = self.redis.get_snapshot(
+            'services', 'aggregates', 'hypervisors')
+        services = snapshot['services']
+        aggregates = snapshot['aggregates']
+        hypervisors = snapshot['hypervisors']
 
         hv_down_az = services[hv_down]['zone']
         hv_down_vcpus = hypervisors[hv_down]['vcpus']
         hv_down_aggregate = aggregates[hv_down]
 
-        _logger.info(f'az: {hv_down_az}, aggregate: {hv_down_aggregate}')
+        self.logger.info(f'az: {hv_down_az}, aggregate: {hv_down_aggregate}')
 
         spare_hv = None
         spare_hvs = []
@@ -374,7 +533,7 @@ class Monitor:
                     status == 'disabled', 'spare' in disables_reason.lower()]):
                 spare_hvs.append(hv)
 
-        _logger.info(f'spare hypervisor candidates: {spare_hvs}')
+        self.logger.info(f'spare hypervisor candidates: {spare_hvs}')
 
         for hv_name in spare_hvs:
             hv = hypervisors[hv_name]
@@ -393,17 +552,71 @@ class Monitor:
         return spare_hv
 
     def resurrect_instances(self, dead_hv, spare_hv):
-        return work_queue.enqueue(resurrect_instances, dead_hv, spare_hv)
+        return self.work_queue.enqueue(
+            'sonny.ns4.resurrect_instances', dead_hv, spare_hv,
+            job_timeout=self.resurrect_timeout(dead_hv))
+
+    def resurrect_timeout(self, dead_hv):
+        """
+        Timeout of resurrection job, long enough to reboot all instances
+        of dead hypervisor at the lowest recovery rate.
+        """
+        if not RECOVERY_RATE:
+            return RESURRECT_TIMEOUT
+
+        instances = len(self.redis.get_hypervisor_instances(dead_hv))
+        return RESURRECT_TIMEOUT + math.ceil(instances / RECOVERY_MIN_RATE)
+
+    def probe_instances(self, instance_ip_list):
+        return self.work_queue.enqueue(
+            'sonny.ns4.probe_any', instance_ip_list, [22])
 
     def inspect_hosts(self, hv_name_list, port_list=[22]):
-        return work_queue.enqueue(nmap_scan, hv_name_list, port_list)
+        if len(hv_name_list) <= SCAN_SHARD_SIZE:
+            return self.work_queue.enqueue(
+                'sonny.ns4.nmap_scan', hv_name_list, port_list)
+
+        shard_size = max(
+            SCAN_SHARD_SIZE, math.ceil(len(hv_name_list) / SCAN_MAX_JOBS))
+        jobs = [
+            self.work_queue.enqueue(
+                'sonny.ns4.nmap_scan', hv_name_list[i:i + shard_size],
+                port_list)
+            for i in range(0, len(hv_name_list), shard_size)
+        ]
+        self.logger.debug(
+            f'scanning {len(hv_name_list)} hosts in {len(jobs)} jobs')
+
+        return JobGroup(jobs, hv_name_list, port_list)
+
+    def refresh_pipelined(self):
+        """
+        Start full inventory refresh in the background once the previous
+        one is done and monitor period elapsed, and return job refreshing
+        agents only. Detection then evaluates fresh agents against the
+        latest complete inventory snapshot, which leaves agents out.
+        """
+        job = self.inventory_job
+        if job is None or job.is_finished or job.is_failed:
+            if time.time() - self.inventory_time >= MONITOR_PERIOD:
+                self.inventory_job = self.refresh_redis_inventory(
+                    update_agents=False)
+                self.inventory_time = time.time()
 
-    def refresh_redis_inventory(self, update_servers=False):
-        last_servers_update = redis.get('servers:timestamp', float)
+        return self.refresh_agents()
+
+    def refresh_agents(self):
+        return self.fast_queue.enqueue('sonny.ns4.refresh_agents')
+
+    def refresh_redis_inventory(self, update_servers=False,
+                                update_agents=True):
+        last_servers_update = self.redis.get('servers:timestamp', float)
         if not last_servers_update or time.time() - last_servers_update > 600:
             update_servers = True
 
-        return work_queue.enqueue(refresh_redis_inventory, update_servers)
+        return self.work_queue.enqueue(
+            'sonny.ns4.refresh_redis_inventory', update_servers,
+            update_agents)
 
 
 def parse_args(args):
@@ -459,7 +672,27 @@ def main(args):
     setup_logging(args.loglevel)
     _logger.debug("starting sonny")
 
-    Monitor().run()
+    if MONITOR_CLOUDS:
+        run_clouds(MONITOR_CLOUDS)
+    else:
+        assert CLOUD is not None
+        Monitor().run()
+
+
+def run_clouds(clouds):
+    """
+    Monitor all clouds in one process, each with its own state and schedule
+    on a shared asyncio event loop.
+    """
+    monitors = [Monitor(cloud) for cloud in clouds]
+    executor = ThreadPoolExecutor(max_workers=len(monitors))
+
+    async def run_monitors():
+        await asyncio.gather(*[
+            monitor.run_async(executor) for monitor in monitors
+        ])
+
+    asyncio.run(run_monitors())
 
 
 def run():
@@ -21,25 +21,48 @@
 from __future__ import division, print_function, absolute_import
 
 import argparse
+import calendar
+import datetime
 import json
+import random
 import re
 import sys
 import logging
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
 
 from nmap import PortScanner
 from openstack.connection import Connection as OpenStack
-from pymysql import connect as mysql_connect, escape_string
-from rq import Worker
+from pymysql import connect as mysql_connect
+from rq import SimpleWorker, Worker, get_current_job
 
 from sonny import __version__
 from sonny.common.config import (
+    BOOT_LATENCY_TARGET,
     CLOUD,
+    INVENTORY_LAYOUT,
+    INVENTORY_TIMEOUT,
+    MYSQL_DB,
     MYSQL_HOST,
+    MYSQL_PORT,
     MYSQL_USER,
-    MYSQL_PASS
+    MYSQL_PASS,
+    NS4_WORKER,
+    PROBE_INTERVAL,
+    PROBE_SAMPLE_SIZE,
+    PROJECT_PRIORITIES,
+    RECOVERY_BURST,
+    RECOVERY_MAX_RATE,
+    RECOVERY_MIN_RATE,
+    RECOVERY_PARALLELISM,
+    RECOVERY_RATE,
+    SCANNER,
+    SERVERS_FULL_SYNC_PERIOD,
+    SERVERS_PAGE_SIZE
 )
 from sonny.common.redis import SonnyRedis
+from sonny.common.scan import HV_PORTS, tcp_scan
 
 __author__ = "Marko Kosmerl"
 __copyright__ = "Marko Kosmerl"
@@ -47,9 +70,27 @@ __license__ = "gpl3"
 
 _logger = logging.getLogger(__name__)
 
-nm = PortScanner()
-os = OpenStack(CLOUD)
+# overlap of changes-since window that covers clock skew with nova
+SERVERS_SYNC_OVERLAP = 60
+# keystone auth state shared by all ns4 processes
+AUTH_STATE_KEY = 'openstack:auth_state'
+# cached auth state expires this many seconds before the token
+TOKEN_EXPIRY_MARGIN = 300
+# instance metadata key with restart priority, higher restarts first
+PRIORITY_METADATA_KEY = 'sonny_priority'
+# token bucket admitting reboots of all ns4 workers
+RECOVERY_BUCKET = 'recovery:bucket'
+# current reboot rate adapted to boot latency
+RECOVERY_RATE_KEY = 'recovery:rate'
+# seconds adapted reboot rate is kept after the last measured boot
+RECOVERY_RATE_TTL = 600
+# seconds to wait for rebooted instance to become active
+BOOT_TIMEOUT = 600
+
+nm = PortScanner() if SCANNER == 'nmap' else None
 redis = SonnyRedis(CLOUD)
+os_conn_cached = None
+db_conn_cached = None
 
 assert CLOUD is not None
 assert MYSQL_HOST is not None
@@ -57,27 +98,131 @@ assert MYSQL_USER is not None
 assert MYSQL_PASS is not None
 
 
+def get_connection():
+    """
+    Long-lived OpenStack connection shared by all jobs of the worker, so
+    HTTP keep-alive connections are reused. The keystone token is cached
+    in redis together with its expiry, so it survives forked jobs and
+    worker restarts.
+    """
+    global os_conn_cached
+    if os_conn_cached is None:
+        os_conn_cached = OpenStack(cloud=CLOUD)
+
+    auth = os_conn_cached.session.auth
+    token = auth.auth_ref.auth_token if auth.auth_ref else None
+    cached_state = redis.get(AUTH_STATE_KEY, str)
+    cached_token = json.loads(cached_state)['auth_token'] \
+        if cached_state else None
+    if cached_token and cached_token != token:
+        auth.set_auth_state(cached_state)
+
+    # re-authenticates only when the token is about to expire
+    access = auth.get_access(os_conn_cached.session)
+    if access.auth_token != cached_token:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        ttl = int((access.expires - now).total_seconds()) - \
+            TOKEN_EXPIRY_MARGIN
+        if ttl > 0:
+            redis.set(AUTH_STATE_KEY, auth.get_auth_state(), ex=ttl)
+
+    return os_conn_cached
+
+
+class SignalingWorkerMixin:
+    """
+    Worker signalling completion of every job in redis, so the monitor does
+    not have to poll job status.
+    """
+
+    def handle_job_success(self, job, queue, started_job_registry):
+        super().handle_job_success(job, queue, started_job_registry)
+        self.connection.signal_job(job.id)
+
+    def handle_job_failure(self, job, started_job_registry=None,
+                           exc_string=''):
+        super().handle_job_failure(job, started_job_registry, exc_string)
+        self.connection.signal_job(job.id)
+
+
+class SignalingSimpleWorker(SignalingWorkerMixin, SimpleWorker):
+    pass
+
+
+class SignalingWorker(SignalingWorkerMixin, Worker):
+    pass
+
+
+def get_db_connection():
+    """
+    Nova database connection kept open between jobs of the worker and
+    pinged (reconnecting when dropped) before it is handed out.
+    """
+    global db_conn_cached
+
+    if db_conn_cached is None:
+        db_conn_cached = mysql_connect(
+            host=MYSQL_HOST, port=MYSQL_PORT, user=MYSQL_USER,
+            passwd=MYSQL_PASS, db=MYSQL_DB)
+    else:
+        db_conn_cached.ping(reconnect=True)
+
+    return db_conn_cached
+
+
+def reassign_instances(instance_list, host):
+    """
+    Move instances to host in nova database with a single parameterized
+    statement in one transaction. Returns number of updated rows.
+    """
+    placeholders = ', '.join(['%s'] * len(instance_list))
+    query = f'''update instances set host = %s, node = %s
+        where uuid in ({placeholders})'''
+
+    db_conn = get_db_connection()
+    try:
+        with db_conn.cursor() as cursor:
+            updated = cursor.execute(query, [host, host] + instance_list)
+        db_conn.commit()
+    except Exception:
+        try:
+            db_conn.rollback()
+        except Exception as e:
+            _logger.warning(f'rollback of nova database update failed: {e}')
+        raise
+
+    return updated
+
+
 def nmap_scan(host_list, port_list=[22]):
     assert isinstance(host_list, list)
     assert len(host_list) > 0
 
     ip_to_hostname = {}
     host_ip_list = []
-    hvs_db = redis.get('hypervisors', json.loads)
+    hostname_list = []
 
     for host in host_list:
         if re.match(r'^(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})$', host):
             host_ip_list.append(host)
         else:
+            hostname_list.append(host)
+
+    if hostname_list:
+        hvs_db = redis.get_hypervisors(hostname_list)
+        for host in hostname_list:
             hv_ip = hvs_db[host]['host_ip']
             ip_to_hostname[hv_ip] = host
             host_ip_list.append(hv_ip)
 
-    results = nm.scan(
-        ' '.join(host_ip_list),
-        ','.join(str(p) for p in port_list)
-    )
-    up_hosts = results['scan'].keys()
+    if SCANNER == 'tcp':
+        up_hosts = tcp_scan(host_ip_list, port_list)
+    else:
+        results = nm.scan(
+            ' '.join(host_ip_list),
+            ','.join(str(p) for p in port_list)
+        )
+        up_hosts = results['scan'].keys()
     down_hosts = set(host_ip_list).difference(set(up_hosts))
 
     down_host_list = []
@@ -88,18 +233,97 @@ def nmap_scan(host_list, port_list=[22]):
     return down_host_list
 
 
-def refresh_redis_inventory(update_servers=False):
-    try:
-        os_conn = OpenStack(
-            session=os.session, cloud=CLOUD, region_name=os.get_region())
+def probe_any(host_list, port_list=[22], sample_size=None):
+    """
+    Probe hosts in random samples, doubling the sample size while no host
+    responds. Returns list with the first host found up or empty list when
+    all hosts are down.
+    """
+    assert isinstance(host_list, list)
+    assert len(host_list) > 0
+
+    sample_size = sample_size or PROBE_SAMPLE_SIZE
+    hosts = random.sample(host_list, len(host_list))
+
+    while hosts:
+        sample, hosts = hosts[:sample_size], hosts[sample_size:]
+        if SCANNER == 'tcp':
+            up_hosts = tcp_scan(sample, port_list, first=True)
+        else:
+            up_hosts = set(sample).difference(nmap_scan(sample, port_list))
 
+        if up_hosts:
+            return sorted(up_hosts)[:1]
+        sample_size *= 2
+
+    return []
+
+
+def probe_hypervisors():
+    """
+    Scan all hypervisors once and record the ones that are up in redis.
+    Returns list of hypervisors that are down.
+    """
+    hv_list = list(redis.get_hypervisors())
+    if not hv_list:
+        return []
+
+    probe_time = time.time()
+    down_hvs = nmap_scan(hv_list, HV_PORTS)
+    redis.set_last_seen(set(hv_list).difference(down_hvs), probe_time)
+
+    return down_hvs
+
+
+def run_prober(interval=None):
+    """
+    Probe hypervisors continuously, starting a sweep every interval seconds.
+    """
+    interval = interval or PROBE_INTERVAL
+
+    while True:
+        start = time.time()
+        try:
+            down_hvs = probe_hypervisors()
+            if down_hvs:
+                _logger.info(f'hypervisors not responding: {down_hvs}')
+        except Exception:
+            _logger.exception('probing hypervisors failed')
+
+        time.sleep(max(0, interval - (time.time() - start)))
+
+
+def refresh_redis_inventory(update_servers=False, update_agents=True):
+    """
+    Run inventory collectors concurrently, each one limited by the
+    inventory timeout. Failures of all collectors are reported together.
+    Collected datasets are published as one atomic snapshot. Agents are
+    left out when they are refreshed separately, so the snapshot does not
+    replace newer heartbeats with the ones collected at its start.
+    """
+    try:
+        os_conn = get_connection()
+
+        snapshot = {}
+        cancelled = threading.Event()
+        collectors = [
+            (update_hypervisors_db, {'snapshot': snapshot}),
+            (update_projects_db, {'snapshot': snapshot}),
+            (update_services_db, {'snapshot': snapshot}),
+            (update_aggregates_db, {'snapshot': snapshot}),
+        ]
+        if update_agents:
+            collectors.append((update_agents_db, {'snapshot': snapshot}))
         if update_servers:
-            update_servers_db(os_conn)
-        update_hypervisors_db(os_conn)
-        update_projects_db(os_conn)
-        update_agents_db(os_conn)
-        update_services_db(os_conn)
-        update_aggregates_db(os_conn)
+            collectors.insert(0, (
+                update_servers_db, {'delta': True, 'cancelled': cancelled}))
+
+        run_collectors(os_conn, collectors, cancelled=cancelled)
+        generation = redis.set_snapshot(snapshot)
+        redis.set_spare_pool(
+            snapshot['services'], snapshot['aggregates'],
+            snapshot['hypervisors'])
+        _logger.debug(f'inventory snapshot {generation} published')
     except Exception as e:
         redis.set('api_alive', 0)
         _logger.error(str(e))
@@ -109,10 +333,74 @@ def refresh_redis_inventory(update_servers=False):
     redis.set('api_alive:timestamp', time.time())
 
 
-def update_aggregates_db(os_conn=None):
+def refresh_agents():
+    """
+    Refresh neutron agents only, the dataset detection of suspicious
+    hypervisors depends on, without waiting for the rest of inventory.
+    """
+    try:
+        update_agents_db()
+    except Exception as e:
+        redis.set('api_alive', 0)
+        _logger.error(str(e))
+        raise e
+
+    redis.set('api_alive', 1)
+    redis.set('api_alive:timestamp', time.time())
+
+
+def store_dataset(name, value, snapshot=None):
+    """
+    Add dataset to snapshot collected by refresh_redis_inventory or store
+    it right away as a snapshot of its own.
+    """
+    if snapshot is None:
+        redis.set_snapshot({name: value})
+    else:
+        snapshot[name] = value
+
+
+def run_collectors(os_conn, collectors, timeout=None, cancelled=None):
+    """
+    Run collectors in parallel and raise errors of all failed ones. When
+    any collector fails, cancelled event is set so collectors still
+    running stop before writing to redis on their own.
+    """
+    timeout = timeout or INVENTORY_TIMEOUT
+    executor = ThreadPoolExecutor(max_workers=len(collectors))
+    futures = [
+        (collector.__name__, executor.submit(collector, os_conn, **kwargs))
+        for collector, kwargs in collectors
+    ]
+
+    deadline = time.time() + timeout
+    exceptions = []
+    for name, future in futures:
+        try:
+            future.result(timeout=max(deadline - time.time(), 0))
+            _logger.debug(f'{name} finished')
+        except TimeoutError:
+            exceptions.append(f'{name}: timed out after {timeout} sec')
+        except Exception as e:
+            exceptions.append(f'{name}: {e}')
+
+    # do not wait for collectors that timed out
+    executor.shutdown(wait=False)
+
+    if exceptions:
+        if cancelled:
+            cancelled.set()
+        raise Exception('\n'.join(exceptions))
+
+
+def check_cancelled(cancelled):
+    if cancelled and cancelled.is_set():
+        raise Exception('collector cancelled')
+
+
+def update_aggregates_db(os_conn=None, snapshot=None):
     if not os_conn:
-        os_conn = OpenStack(
-            session=os.session, cloud=CLOUD, region_name=os.get_region())
+        os_conn = get_connection()
 
     aggregates_os = os_conn.list_aggregates()
     aggregates = {}
@@ -120,14 +408,12 @@ def update_aggregates_db(os_conn=None):
         for host in aggregate.hosts:
             aggregates[host] = aggregate.name
 
-    redis.set('aggregates', json.dumps(aggregates))
-    redis.set('aggregates:timestamp', time.time())
+    store_dataset('aggregates', aggregates, snapshot)
 
 
-def update_services_db(os_conn=None):
+def update_services_db(os_conn=None, snapshot=None):
     if not os_conn:
-        os_conn = OpenStack(
-            session=os.session, cloud=CLOUD, region_name=os.get_region())
+        os_conn = get_connection()
 
     services_os = os_conn.compute.services()
     services = {
@@ -135,38 +421,32 @@ def update_services_db(os_conn=None):
         if s.binary == 'nova-compute'
     }
 
-    redis.set('services', json.dumps(services))
-    redis.set('services:timestamp', time.time())
+    store_dataset('services', services, snapshot)
 
 
-def update_projects_db(os_conn=None):
+def update_projects_db(os_conn=None, snapshot=None):
     if not os_conn:
-        os_conn = OpenStack(
-            session=os.session, cloud=CLOUD, region_name=os.get_region())
+        os_conn = get_connection()
 
     projects_os = os_conn.identity.projects()
     projects = {t.id: t.to_dict() for t in projects_os}
 
-    redis.set('projects', json.dumps(projects))
-    redis.set('projects:timestamp', time.time())
+    store_dataset('projects', projects, snapshot)
 
 
-def update_hypervisors_db(os_conn=None):
+def update_hypervisors_db(os_conn=None, snapshot=None):
     if not os_conn:
-        os_conn = OpenStack(
-            session=os.session, cloud=CLOUD, region_name=os.get_region())
+        os_conn = get_connection()
 
     hypervisors_os = os_conn.compute.hypervisors(True)
     hypervisors = {hv.name: hv.to_dict() for hv in hypervisors_os}
 
-    redis.set('hypervisors', json.dumps(hypervisors))
-    redis.set('hypervisors:timestamp', time.time())
+    store_dataset('hypervisors', hypervisors, snapshot)
 
 
-def update_agents_db(os_conn=None):
+def update_agents_db(os_conn=None, snapshot=None):
     if not os_conn:
-        os_conn = OpenStack(
-            session=os.session, cloud=CLOUD, region_name=os.get_region())
+        os_conn = get_connection()
 
     agents_os = [
         (a.host, a.binary, a.last_heartbeat_at)
@@ -174,25 +454,76 @@ def update_agents_db(os_conn=None):
     ]
     agents = {}
     for host, binary, heartbeat in agents_os:
-        agents.setdefault(host, {})[binary] = heartbeat
+        agent_dict = agents.setdefault(host, {})
+        if heartbeat:
+            agent_dict[binary] = heartbeat_timestamp(heartbeat)
 
-    redis.set('agents', json.dumps(agents))
-    redis.set('agents:timestamp', time.time())
+    store_dataset('agents', agents, snapshot)
 
 
-def update_servers_db(os_conn=None):
-    if not os_conn:
-        os_conn = OpenStack(
-            session=os.session, cloud=CLOUD, region_name=os.get_region())
-
-    servers_os = os_conn.compute.servers(all_tenants=True)
-    servers = {}
+def heartbeat_timestamp(heartbeat):
+    """
+    Convert agent heartbeat reported by neutron in UTC to epoch.
+    """
+    heartbeat_time = datetime.datetime.strptime(heartbeat, '%Y-%m-%d %H:%M:%S')
+    return float(calendar.timegm(heartbeat_time.timetuple()))
 
-    for server in servers_os:
-        servers[server.id] = server.to_dict()
 
-    redis.set('servers', json.dumps(servers))
-    redis.set('servers:timestamp', time.time())
+def update_servers_db(os_conn=None, delta=False, cancelled=None):
+    """
+    Update servers inventory. In delta mode only servers changed since the
+    last sync (including deleted ones) are fetched and merged, unless the
+    full sync period has elapsed. Nothing is written once cancelled event
+    is set.
+    """
+    if not os_conn:
+        os_conn = get_connection()
+
+    sync_time = time.time()
+    last_sync = redis.get('servers:timestamp', float)
+    last_full_sync = redis.get('servers:full_sync:timestamp', float)
+
+    if delta and last_sync and last_full_sync and \
+       sync_time - last_full_sync < SERVERS_FULL_SYNC_PERIOD:
+        changes_since = datetime.datetime.utcfromtimestamp(
+            last_sync - SERVERS_SYNC_OVERLAP).strftime('%Y-%m-%dT%H:%M:%SZ')
+        servers_os = os_conn.compute.servers(
+            all_tenants=True, changes_since=changes_since)
+
+        servers, deleted = {}, []
+        for server in servers_os:
+            if server.status == 'DELETED':
+                deleted.append(server.id)
+            else:
+                servers[server.id] = server.to_dict()
+
+        _logger.debug(f'servers changed since {changes_since}: '
+                      f'{len(servers)} updated, {len(deleted)} deleted')
+        check_cancelled(cancelled)
+        redis.update_servers(servers, deleted)
+    elif INVENTORY_LAYOUT == 'hash':
+        def servers_iter():
+            servers_os = os_conn.compute.servers(
+                all_tenants=True, limit=SERVERS_PAGE_SIZE)
+            for server in servers_os:
+                check_cancelled(cancelled)
+                yield server.to_dict()
+            check_cancelled(cancelled)
+
+        redis.stream_servers(servers_iter(), SERVERS_PAGE_SIZE)
+        redis.set('servers:full_sync:timestamp', sync_time)
+    else:
+        servers_os = os_conn.compute.servers(all_tenants=True)
+        servers = {}
+
+        for server in servers_os:
+            servers[server.id] = server.to_dict()
+
+        check_cancelled(cancelled)
+        redis.set_servers(servers)
+        redis.set('servers:full_sync:timestamp', sync_time)
+
+    redis.set('servers:timestamp', sync_time)
 
 
 def reset_cooldown():
@@ -203,14 +534,13 @@ def reset_cooldown():
 def resurrect_instances(dead_hv, spare_hv, update_db=True):
     assert dead_hv != spare_hv
 
-    os_conn = OpenStack(
-        session=os.session, cloud=CLOUD, region_name=os.get_region())
+    os_conn = get_connection()
 
     if update_db:
         _logger.info('updating redis database')
         refresh_redis_inventory(True)
 
-    spare_hv_r = redis.get('hypervisors', json.loads)[spare_hv]
+    spare_hv_r = redis.get_hypervisor(spare_hv)
     assert spare_hv_r['running_vms'] == 0
     dead_service = spare_service = None
     for svc in os_conn.compute.services():
@@ -230,58 +560,31 @@ def resurrect_instances(dead_hv, spare_hv, update_db=True):
     if not nmap_scan([dead_hv], [22, 111, 16509]):
         raise Exception(f'hypervisor {dead_hv} does not seem to be dead!')
 
-    instance_list = []
-    servers = json.loads(redis.get('servers'))
-    for _, server in servers.items():
-        if server['hypervisor_hostname'] == spare_hv:
-            raise Exception(f'spare hypervisor {spare_hv} has vms assigned!')
-        if server['hypervisor_hostname'] == dead_hv:
-            instance_list.append(server['id'])
-            server['hypervisor_hostname'] = spare_hv
+    if redis.get_hypervisor_instances(spare_hv):
+        raise Exception(f'spare hypervisor {spare_hv} has vms assigned!')
 
+    instances = redis.get_hypervisor_instances(dead_hv)
+    instance_list = list(instances)
     if not instance_list:
         _logger.warning(f'{dead_hv} does not run any instances')
         return
 
     _logger.info('updating database records in nova')
-    db_conn = mysql_connect(
-        host=MYSQL_HOST, user=MYSQL_USER, passwd=MYSQL_PASS, db='nova')
-    try:
-        spare_hv = escape_string(spare_hv)
-        with db_conn.cursor() as cursor:
-            for uuid in instance_list:
-                uuid = escape_string(uuid)
-                query = \
-                    f'''update instances set
-                    host = "{spare_hv}", node = "{spare_hv}"
-                    where uuid="{uuid}"'''
-                _logger.debug(query)
-                cursor.execute(query)
-        db_conn.commit()
-    finally:
-        db_conn.close()
+    updated = reassign_instances(instance_list, spare_hv)
+    _logger.debug(f'{updated} of {len(instance_list)} instances updated')
 
     _logger.info('updating servers inventory db')
-    redis.set('servers', json.dumps(servers))
-
-    exceptions = []
-    for uuid in instance_list:
-        try:
-            if servers[uuid]['vm_state'] == 'stopped':
-                _logger.info(f'instance {uuid} is stoppped, not rebooting')
-                continue
-
-            _logger.info(f'hard rebooting instance {uuid}')
-            os_conn.compute.reboot_server(uuid, 'HARD')
-            for ifce in os_conn.compute.server_interfaces(uuid):
-                _logger.info(f'updating port binding on {ifce.port_id}')
-                port = os_conn.get_port(ifce.port_id)
-                if port:
-                    os_conn.network.update_port(
-                        port, **{'binding:host_id': spare_hv})
-        except Exception as e:
-            exceptions.append(str(e))
+    servers = {
+        uuid: dict(server, hypervisor_hostname=spare_hv)
+        for uuid, server in redis.get_servers(instance_list).items()
+    }
+    redis.update_servers(servers)
 
+    instance_list.sort(
+        key=lambda uuid: instance_priority(servers.get(uuid, {})),
+        reverse=True)
+    instances = {uuid: instances[uuid] for uuid in instance_list}
+    exceptions = recover_instances(os_conn, instances, spare_hv)
     if exceptions:
         raise Exception('\n'.join(exceptions))
 
@@ -291,6 +594,156 @@ def resurrect_instances(dead_hv, spare_hv, update_db=True):
     os_conn.compute.enable_service(spare_service, spare_hv, 'nova-compute')
 
 
+def recover_instances(os_conn, instances, spare_hv, parallelism=None):
+    """
+    Reboot instances and rebind their ports to spare hypervisor, at most
+    parallelism instances at the same time, in the order of instances.
+    With recovery rate limited, boots are watched in separate threads
+    until all instances are rebooted, so reboots do not wait for them.
+    Progress is reported per instance in the current job meta. Returns
+    list of errors.
+    """
+    parallelism = parallelism or RECOVERY_PARALLELISM
+    job = get_current_job()
+    progress = {'recovered': [], 'failed': {}, 'total': len(instances)}
+
+    exceptions = []
+    rebooted = threading.Event()
+    with ThreadPoolExecutor(max_workers=parallelism) as executor, \
+            ThreadPoolExecutor(max_workers=parallelism) as boot_executor:
+        futures = {
+            executor.submit(
+                recover_instance, os_conn, uuid, instance, spare_hv): uuid
+            for uuid, instance in instances.items()
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            uuid = futures[future]
+            try:
+                reboot_time = future.result()
+                if RECOVERY_RATE and reboot_time:
+                    boot_executor.submit(
+                        watch_boot, os_conn, uuid, reboot_time, rebooted)
+                progress['recovered'].append(uuid)
+                _logger.info(
+                    f'instance {uuid} recovered ({done}/{len(futures)})')
+            except Exception as e:
+                exceptions.append(f'{uuid}: {e}')
+                progress['failed'][uuid] = str(e)
+                _logger.warning(
+                    f'instance {uuid} failed ({done}/{len(futures)}): {e}')
+
+            if job:
+                job.meta['progress'] = progress
+                job.save_meta()
+
+        rebooted.set()
+
+    return exceptions
+
+
+def recover_instance(os_conn, uuid, instance, spare_hv):
+    """
+    Hard reboot instance and rebind its ports to spare hypervisor. Returns
+    time of the reboot, None when stopped instance is not rebooted.
+    """
+    if instance['vm_state'] == 'stopped':
+        _logger.info(f'instance {uuid} is stoppped, not rebooting')
+        return None
+
+    if RECOVERY_RATE:
+        acquire_reboot_token()
+
+    _logger.info(f'hard rebooting instance {uuid}')
+    reboot_time = time.time()
+    os_conn.compute.reboot_server(uuid, 'HARD')
+    for ifce in os_conn.compute.server_interfaces(uuid):
+        _logger.info(f'updating port binding on {ifce.port_id}')
+        port = os_conn.get_port(ifce.port_id)
+        if port:
+            os_conn.network.update_port(
+                port, **{'binding:host_id': spare_hv})
+
+    return reboot_time
+
+
+def watch_boot(os_conn, uuid, reboot_time, stopped=None):
+    """
+    Adapt reboot rate to boot latency of rebooted instance, unless
+    watching is stopped before it is known whether the boot is slow.
+    """
+    try:
+        boot_latency = wait_for_boot(
+            os_conn, uuid, reboot_time, stopped=stopped)
+    except Exception as e:
+        _logger.warning(f'watching boot of instance {uuid} failed: {e}')
+        return
+
+    if boot_latency is not None:
+        _logger.debug(f'instance {uuid} booted in {boot_latency:.0f} sec')
+        adapt_recovery_rate(boot_latency)
+
+
+def instance_priority(server):
+    """
+    Restart priority of instance from its metadata or its project.
+    """
+    try:
+        return int(server['metadata'][PRIORITY_METADATA_KEY])
+    except (KeyError, TypeError, ValueError):
+        return PROJECT_PRIORITIES.get(server.get('project_id'), 0)
+
+
+def acquire_reboot_token():
+    """
+    Block until reboot is admitted by token bucket shared by all workers.
+    """
+    while True:
+        rate = redis.get(RECOVERY_RATE_KEY, float) or RECOVERY_RATE
+        wait = redis.take_token(RECOVERY_BUCKET, rate, RECOVERY_BURST)
+        if not wait:
+            return
+
+        time.sleep(wait)
+
+
+def adapt_recovery_rate(boot_latency):
+    """
+    Halve reboot rate when instances boot slower than the target and
+    increase it step by step while they boot fast.
+    """
+    rate = redis.get(RECOVERY_RATE_KEY, float) or RECOVERY_RATE
+    if boot_latency > BOOT_LATENCY_TARGET:
+        rate = max(RECOVERY_MIN_RATE, rate / 2)
+    else:
+        rate = min(RECOVERY_MAX_RATE, rate + RECOVERY_RATE / 10)
+    redis.set(RECOVERY_RATE_KEY, rate, ex=RECOVERY_RATE_TTL)
+
+    return rate
+
+
+def wait_for_boot(os_conn, uuid, reboot_time, timeout=BOOT_TIMEOUT,
+                  stopped=None):
+    """
+    Wait for rebooted instance to become active and return seconds since
+    reboot. Instance in error state counts as booting for timeout seconds.
+    When stopped event is set before the instance is active, returns
+    seconds since reboot if they are already over the boot latency target
+    and None otherwise.
+    """
+    stopped = stopped or threading.Event()
+    while time.time() - reboot_time < timeout:
+        server = os_conn.compute.get_server(uuid)
+        if server.status == 'ACTIVE':
+            break
+        elif server.status == 'ERROR':
+            return timeout
+        if stopped.wait(2):
+            elapsed = time.time() - reboot_time
+            return elapsed if elapsed > BOOT_LATENCY_TARGET else None
+
+    return time.time() - reboot_time
+
+
 def parse_args(args):
     """Parse command line parameters
 
@@ -334,6 +787,12 @@ def parse_args(args):
         action='store_true',
         help='reset cooldown period')
 
+    parser.add_argument(
+        '-p',
+        '--prober',
+        action='store_true',
+        help='probe hypervisors continuously instead of running worker')
+
     return parser.parse_args(args)
 
 
@@ -373,8 +832,20 @@ def main(args):
         reset_cooldown()
         return
 
+    if args.prober:
+        _logger.debug("started hypervisor prober")
+        run_prober()
+        return
+
     _logger.debug("started monitor")
-    Worker(['default'], connection=redis).work()
+    try:
+        get_connection()
+    except Exception as e:
+        # first job connects again, failures are reported through api_alive
+        _logger.warning(f'connecting to openstack failed: {e}')
+    worker_class = SignalingSimpleWorker if NS4_WORKER == 'simple' \
+        else SignalingWorker
+    worker_class(['fast', 'default'], connection=redis).work()
 
 
 def run():
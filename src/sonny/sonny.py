@@ -25,6 +25,7 @@ import re
 import signal
 import sys
 import time
+import yaml
 from collections import deque
 
 from slackclient import SlackClient
@@ -144,7 +145,12 @@ class Sonny:
                     if response:
                         break
                 else:
-                    response = 'not found'
+                    matches = [
+                        f'{cloud}: {match}' for cloud in CLOUDS
+                        for match in self._redis[cloud].show_matches(command)
+                    ]
+                    response = yaml.dump(matches) if matches \
+                        else 'not found'
         elif command.startswith('status'):
             response = []
             for cloud in CLOUDS:
@@ -20,24 +20,32 @@
 
 import fakeredis
 
+from sonny.common.redis import SonnyRedis
+
 __author__ = "Marko Kosmerl"
 __copyright__ = "Marko Kosmerl"
 __license__ = "gpl3"
 
 
-class FakeSonnyRedis(fakeredis.FakeStrictRedis):
+def parse_stream_list(response):
+    # fakeredis nests stream entry fields in an extra list
+    return [(entry_id, dict(zip(fields[0][::2], fields[0][1::2])))
+            for entry_id, fields in response]
+
+
+class FakeSonnyRedis(SonnyRedis, fakeredis.FakeStrictRedis):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-
-    def get(self, name, value_type=None):
-        value = super().get(name)
-
-        if value and value_type is str:
-            return value.decode('utf-8')
-        elif value and value_type:
-            return value_type(value)
-        elif value:
-            return value
-        else:
-            return None
+        self.set_response_callback('XRANGE', parse_stream_list)
+
+    # fakeredis does not support MAXLEN option of XADD
+    def xadd(self, name, fields, id='*', maxlen=None, approximate=True):
+        return super().xadd(name, fields, id)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super().pipeline(transaction, shard_hint)
+        xadd = pipe.xadd
+        pipe.xadd = lambda name, fields, id='*', maxlen=None, \
+            approximate=True: xadd(name, fields, id)
+        return pipe
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    Sonny
+#
+#    Copyright (C) 2018  Marko Kosmerl
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import pytest
+
+from sonny.common.codec import dumps, loads
+
+__author__ = "Marko Kosmerl"
+__copyright__ = "Marko Kosmerl"
+__license__ = "gpl3"
+
+VALUE = {'hv1': {'vcpus': 32, 'state': 'up', 'servers': ['a', 'b']}}
+
+
+def test_json_without_header():
+    value = dumps(VALUE, 'json', 'none')
+
+    assert json.loads(value) == VALUE
+    assert loads(value) == VALUE
+    assert loads(json.dumps(VALUE)) == VALUE
+
+
+@pytest.mark.parametrize('codec,compression', [
+    ('json', 'zlib'),
+    ('json', 'lz4'),
+    ('msgpack', 'none'),
+    ('msgpack', 'zlib'),
+    ('msgpack', 'lz4'),
+])
+def test_codecs(codec, compression):
+    if codec == 'msgpack':
+        pytest.importorskip('msgpack')
+    if compression == 'lz4':
+        pytest.importorskip('lz4.frame')
+
+    value = dumps(VALUE, codec, compression)
+
+    assert value.startswith(b'\x00')
+    assert loads(value) == VALUE
@@ -23,6 +23,7 @@ from unittest.mock import MagicMock, patch
 
 import json
 import pytest
+import subprocess
 import time
 import sys
 
@@ -45,9 +46,12 @@ def monitor():
         monitor = sonny.monitor.Monitor()
 
         monitor.redis = sonny.monitor.redis
+        monitor.logger = sonny.monitor._logger
         monitor.redis.flushall()
         monitor.api_alive = 1
         monitor.last_run_backed_off = 0
+        monitor.fast_cycle = False
+        monitor.healthy_steps = 0
 
         monitor.wait_for_job = MagicMock(return_value=True)
 
@@ -80,6 +84,29 @@ def test_db_value(monitor):
     assert monitor.redis.get('list', json.loads) == ['test']
 
 
+def test_get_suspicious_hypervisors(monitor):
+    def hypervisor(state='up', status='enabled', running_vms=1):
+        return {'state': state, 'status': status, 'running_vms': running_vms,
+                'service_details': {'disabled_reason': None}}
+
+    now = time.time()
+    monitor.redis.set_inventory('hypervisors', {
+        'hv1': hypervisor(),
+        'hv2': hypervisor(),
+        'hv3': hypervisor(running_vms=0),
+        'hv4': hypervisor(status='disabled', running_vms=2),
+    })
+    monitor.redis.set_heartbeats({
+        'hv1': {'nova-compute': now},
+        'hv2': {'nova-compute': now - 600, 'ovs-agent': now - 300},
+        'hv3': {'nova-compute': now - 600},
+        'hv4': {'nova-compute': now - 600},
+        'hv5': {'nova-compute': now - 600},
+    })
+
+    assert sorted(monitor.get_suspicious_hypervisors()) == ['hv2', 'hv4']
+
+
 def test_get_instances(monitor):
 
     instance = {
@@ -106,6 +133,12 @@ def test_inspect_hypervisors(monitor):
     assert monitor.inspect_hypervisors(['hv1']) == (True, [])
 
 
+def test_inspect_hypervisors_prober(monitor):
+    monitor.redis.set_last_seen(['hv1'], time.time())
+    assert monitor.inspect_hypervisors(['hv1', 'hv2']) == (True, ['hv2'])
+    monitor.inspect_hosts.assert_not_called()
+
+
 def test_inspect_instances(monitor):
     u_hvs = ['hv42']
     instances = [(1, '192.168.1.1'), (2, '192.168.1.2'), (3, '192.168.1.3')]
@@ -125,6 +158,46 @@ def test_inspect_instances(monitor):
         assert expected == returned
 
 
+def test_inspect_instances_sample(monitor):
+    instances = [(1, '192.168.1.1'), (2, '192.168.1.2'), (3, '192.168.1.3')]
+    monitor.get_instances = MagicMock(return_value=instances)
+    monitor.probe_instances = MagicMock()
+    monitor.probe_instances.return_value.id = randint(1, 1000000)
+
+    with patch.object(sonny.monitor, 'INSTANCE_PROBE', 'sample'):
+        monitor.probe_instances.return_value.result = ['192.168.1.2']
+        assert monitor.inspect_instances(['hv42']) == ([], ['hv42'])
+
+        monitor.probe_instances.return_value.result = []
+        assert monitor.inspect_instances(['hv42']) == (['hv42'], [])
+
+    monitor.inspect_hosts.assert_not_called()
+
+
+def test_wait_for_jobs(monitor):
+    jobs = []
+    for job_id in ['job1', 'job2', 'job3']:
+        job = MagicMock(id=job_id, is_finished=False, is_failed=False)
+        jobs.append(job)
+
+    done = monitor.wait_for_jobs(jobs, timeout=10)
+    jobs[2].is_finished = True
+    assert next(done) is jobs[2]
+
+    # only the signaled job is checked after waking up
+    jobs[0].is_finished = True
+    jobs[1].is_failed = True
+    monitor.redis.signal_job('job2')
+    assert next(done) is jobs[1]
+    monitor.redis.signal_job('job1')
+    assert next(done) is jobs[0]
+
+    job = MagicMock(id='job4', is_finished=False, is_failed=False)
+    start = time.time()
+    assert not sonny.monitor.Monitor.wait_for_job(monitor, job, timeout=1)
+    assert time.time() - start < 3
+
+
 def test_handle_dead_hypervisors1(monitor):
     # successfully handle 2 dead hypervisors
     dead_hvs = ['hv10', 'hv11']
@@ -180,6 +253,25 @@ def test_handle_dead_hypervisors2(monitor):
     assert monitor.redis.get('resurrection:timestamp')
 
 
+def test_allocate_spare_hypervisors(monitor):
+    monitor.get_spare_hypervisor = MagicMock(side_effect=['hv9', None])
+    assert monitor.allocate_spare_hypervisors(['hv1', 'hv2', 'hv3']) == \
+        {'hv1': 'hv9', 'hv2': None}
+    monitor.get_spare_hypervisor.assert_called_with('hv2', {'hv9'})
+
+    monitor.get_spare_hypervisor.reset_mock()
+    monitor.redis.set_spare_pool(
+        {'hv1': {'state': 'down', 'status': 'enabled', 'zone': 'az1',
+                 'disables_reason': None},
+         'hv9': {'state': 'up', 'status': 'disabled', 'zone': 'az1',
+                 'disables_reason': 'spare'}},
+        {'hv1': 'agg1', 'hv9': 'agg1'},
+        {'hv1': {'vcpus': 32, 'vcpus_used': 8},
+         'hv9': {'vcpus': 32, 'vcpus_used': 0}})
+    assert monitor.allocate_spare_hypervisors(['hv1']) == {'hv1': 'hv9'}
+    monitor.get_spare_hypervisor.assert_not_called()
+
+
 def test_handle_dead_hypervisors3(monitor):
     # dead backoff
     monitor.get_spare_hypervisor = MagicMock()
@@ -263,3 +355,163 @@ def test_run_step3(monitor):
     monitor.inspect_instances.return_value = (['hv42'], [])
     monitor.run_step()
     monitor.handle_dead_hypervisors.assert_called_once()
+
+
+def test_inspect_hosts_sharded():
+    with patch.object(sonny.monitor.Monitor, '__init__', lambda _: None), \
+            patch.object(sonny.monitor, 'SCAN_SHARD_SIZE', 2), \
+            patch.object(sonny.monitor, 'SCAN_MAX_JOBS', 2):
+        def enqueue(func, host_list, port_list):
+            job = MagicMock()
+            job.id = str(randint(1, 1000000))
+            job.is_finished = True
+            job.is_failed = False
+            job.result = host_list[:1]
+            return job
+
+        monitor = sonny.monitor.Monitor()
+        monitor.logger = sonny.monitor._logger
+        monitor.work_queue = work_queue = MagicMock()
+        work_queue.enqueue.side_effect = enqueue
+
+        monitor.inspect_hosts(['1', '2'])
+        assert work_queue.enqueue.call_count == 1
+
+        work_queue.enqueue.reset_mock()
+        job = monitor.inspect_hosts(['1', '2', '3', '4', '5'])
+        assert work_queue.enqueue.call_count == 2
+        assert job.args == (['1', '2', '3', '4', '5'], [22])
+        assert job.is_finished and not job.is_failed
+        assert job.result == ['1', '4']
+
+        job.jobs[1].is_finished = False
+        job.jobs[1].is_failed = True
+        assert job.is_failed and job.result is None
+
+
+def test_refresh_pipelined(monitor):
+    monitor.inventory_job = None
+    monitor.inventory_time = 0
+    monitor.refresh_agents = MagicMock()
+    inventory_job = monitor.refresh_redis_inventory.return_value
+    inventory_job.is_finished = False
+    inventory_job.is_failed = False
+
+    assert monitor.refresh_pipelined() is monitor.refresh_agents.return_value
+    assert monitor.inventory_job is inventory_job
+    # agents are refreshed on their own, not by the background refresh
+    monitor.refresh_redis_inventory.assert_called_once_with(
+        update_agents=False)
+
+    # full refresh still running, only agents are refreshed
+    monitor.inventory_time = 0
+    monitor.refresh_pipelined()
+    assert monitor.refresh_redis_inventory.call_count == 1
+    assert monitor.refresh_agents.call_count == 2
+
+    # full refresh done but monitor period not elapsed yet
+    inventory_job.is_finished = True
+    monitor.inventory_time = time.time()
+    monitor.refresh_pipelined()
+    assert monitor.refresh_redis_inventory.call_count == 1
+
+    monitor.inventory_time = 0
+    monitor.refresh_pipelined()
+    assert monitor.refresh_redis_inventory.call_count == 2
+
+
+def test_run_step_pipelined(monitor):
+    monitor.refresh_pipelined = MagicMock()
+    monitor.get_suspicious_hypervisors = MagicMock(return_value=[])
+
+    with patch.object(sonny.monitor, 'MONITOR_MODE', 'pipelined'):
+        monitor.run_step()
+
+    monitor.refresh_pipelined.assert_called_once()
+    monitor.refresh_redis_inventory.assert_not_called()
+    monitor.get_suspicious_hypervisors.assert_called_once()
+
+
+def test_update_cadence(monitor):
+    with patch.object(sonny.monitor, 'MONITOR_CADENCE', 'adaptive'), \
+            patch.object(sonny.monitor, 'MONITOR_CALM_STEPS', 2), \
+            patch.object(sonny.monitor, 'MONITOR_MIN_PERIOD', 10), \
+            patch.object(sonny.monitor, 'MONITOR_MAX_PERIOD', 300):
+        assert monitor.period == 300
+
+        monitor.update_cadence(False)
+        assert monitor.fast_cycle and monitor.period == 10
+
+        monitor.update_cadence(True)
+        monitor.update_cadence(False)
+        monitor.update_cadence(True)
+        assert monitor.period == 10
+
+        monitor.update_cadence(True)
+        assert not monitor.fast_cycle and monitor.period == 300
+
+    monitor.update_cadence(False)
+    assert not monitor.fast_cycle
+
+
+def test_run_step_fast_cycle(monitor):
+    monitor.refresh_pipelined = MagicMock()
+    monitor.inspect_hypervisors = MagicMock(return_value=(True, []))
+    monitor.get_suspicious_hypervisors = MagicMock(return_value=['hv1'])
+
+    with patch.object(sonny.monitor, 'MONITOR_CADENCE', 'adaptive'):
+        monitor.run_step()
+        monitor.refresh_redis_inventory.assert_called_once()
+        assert monitor.fast_cycle
+
+        monitor.run_step()
+        monitor.refresh_pipelined.assert_called_once()
+
+
+def test_run_clouds():
+    steps = []
+
+    def init(self, cloud):
+        self.cloud = cloud
+        self.logger = sonny.monitor._logger
+        self.redis = FakeSonnyRedis()
+
+    def run_step(self):
+        steps.append(self.cloud)
+        if len(steps) >= 4:
+            raise SystemExit()
+
+    with patch.object(sonny.monitor.Monitor, '__init__', init), \
+            patch.object(sonny.monitor.Monitor, 'run_step', run_step), \
+            patch.object(sonny.monitor.Monitor, 'period', 0):
+        with pytest.raises(SystemExit):
+            sonny.monitor.run_clouds(['cloud1', 'cloud2'])
+
+    assert set(steps) == {'cloud1', 'cloud2'}
+
+
+def test_ns4_not_imported():
+    # ns4 connects to openstack, mysql and redis of its cloud on import
+    code = 'import sys, sonny.monitor; print("sonny.ns4" in sys.modules)'
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert output.strip() == b'False'
+
+    monitor = sonny.monitor.Monitor.__new__(sonny.monitor.Monitor)
+    monitor.work_queue = MagicMock()
+    monitor.resurrect_instances('hv1', 'hv2')
+    monitor.work_queue.enqueue.assert_called_once_with(
+        'sonny.ns4.resurrect_instances', 'hv1', 'hv2', job_timeout=600)
+
+
+def test_resurrect_timeout(monitor):
+    monitor.redis.flushall()
+    monitor.redis.set_servers({
+        'uuid1': {'name': 'vm1', 'hypervisor_hostname': 'hv1'},
+        'uuid2': {'name': 'vm2', 'hypervisor_hostname': 'hv1'},
+    })
+    assert monitor.resurrect_timeout('hv1') == 600
+
+    with patch.object(sonny.monitor, 'RECOVERY_RATE', 1), \
+            patch.object(sonny.monitor, 'RECOVERY_MIN_RATE', 0.05):
+        assert monitor.resurrect_timeout('hv1') == 640
+        assert monitor.resurrect_timeout('hv2') == 600
@@ -18,10 +18,15 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
+import datetime
 import json
 import pytest
+import threading
+import time
+
+from rq import Queue
 
 import sonny.ns4 as ns4
 from .fakesonnyredis import FakeSonnyRedis
@@ -40,15 +45,36 @@ def teardown_module():
 
 
 def test_refresh_redis_inventory():
-    ns4.update_hypervisors_db = MagicMock()
-    ns4.update_hypervisors_db.side_effect = Exception('OS API Issue')
+    with patch.object(ns4, 'get_connection'), \
+            patch.object(ns4, 'update_hypervisors_db') as update_hvs_db:
+        update_hvs_db.__name__ = 'update_hypervisors_db'
+        update_hvs_db.side_effect = Exception('OS API Issue')
 
-    with pytest.raises(Exception):
-        ns4.refresh_redis_inventory()
+        with pytest.raises(Exception, match='OS API Issue'):
+            ns4.refresh_redis_inventory()
 
+        update_hvs_db.assert_called_once()
     assert ns4.redis.get('api_alive') == b'0'
 
 
+def test_refresh_redis_inventory_without_agents():
+    def collect(os_conn, collectors, cancelled=None):
+        for name in ['hypervisors', 'services', 'aggregates']:
+            collectors[0][1]['snapshot'][name] = {}
+
+    with patch.object(ns4, 'get_connection'), \
+            patch.object(ns4, 'run_collectors',
+                         side_effect=collect) as run_collectors:
+        ns4.refresh_redis_inventory(update_agents=False)
+        collectors = [c for c, _ in run_collectors.call_args[0][1]]
+        assert ns4.update_agents_db not in collectors
+        assert ns4.update_services_db in collectors
+
+        ns4.refresh_redis_inventory()
+        collectors = [c for c, _ in run_collectors.call_args[0][1]]
+        assert ns4.update_agents_db in collectors
+
+
 def test_nmap_scan_up():
     input = '10.66.0.142'
     output = \
@@ -100,3 +126,300 @@ def test_nmap_scan_down():
 
     assert result == [input]
     ns4.nm.scan.assert_called_once_with(input, '22')
+
+
+def test_update_servers_db_delta():
+    def server(uuid, status='ACTIVE'):
+        s = MagicMock()
+        s.id = uuid
+        s.status = status
+        s.to_dict.return_value = {'id': uuid, 'name': uuid, 'status': status}
+        return s
+
+    os_conn = MagicMock()
+    os_conn.compute.servers.return_value = [server('uuid1'), server('uuid2')]
+    ns4.redis.flushall()
+
+    # first sync is always full
+    ns4.update_servers_db(os_conn, delta=True)
+    os_conn.compute.servers.assert_called_once_with(
+        all_tenants=True, limit=ns4.SERVERS_PAGE_SIZE)
+    assert set(ns4.redis.get_servers()) == {'uuid1', 'uuid2'}
+
+    os_conn.compute.servers.reset_mock()
+    os_conn.compute.servers.return_value = [
+        server('uuid2', 'DELETED'), server('uuid3')]
+    ns4.update_servers_db(os_conn, delta=True)
+    _, kwargs = os_conn.compute.servers.call_args
+    assert 'changes_since' in kwargs
+    assert set(ns4.redis.get_servers()) == {'uuid1', 'uuid3'}
+
+
+def test_run_collectors():
+    def ok(os_conn):
+        pass
+
+    def fail(os_conn):
+        raise Exception('OS API Issue')
+
+    def slow(os_conn, delay):
+        time.sleep(delay)
+
+    ns4.run_collectors(None, [(ok, {}), (slow, {'delay': 0.1})], 1)
+
+    with pytest.raises(Exception) as e:
+        ns4.run_collectors(
+            None, [(ok, {}), (fail, {}), (slow, {'delay': 1})], 0.2)
+    assert 'fail: OS API Issue' in str(e.value)
+    assert 'slow: timed out' in str(e.value)
+    assert 'ok' not in str(e.value)
+
+
+def test_run_collectors_cancelled():
+    def server(uuid):
+        s = MagicMock()
+        s.id = uuid
+        s.to_dict.return_value = {'id': uuid, 'name': uuid}
+        return s
+
+    def slow_servers(**kwargs):
+        yield server('uuid1')
+        time.sleep(0.3)
+        yield server('uuid2')
+
+    os_conn = MagicMock()
+    os_conn.compute.servers.side_effect = slow_servers
+    ns4.redis.flushall()
+
+    cancelled = threading.Event()
+    with pytest.raises(Exception):
+        ns4.run_collectors(os_conn, [
+            (ns4.update_servers_db, {'delta': True, 'cancelled': cancelled})
+        ], 0.1, cancelled)
+    assert cancelled.is_set()
+
+    # collector that timed out stops before writing anything
+    time.sleep(0.4)
+    assert ns4.redis.get_servers() == {}
+    assert ns4.redis.get('servers:timestamp') is None
+
+
+def test_update_agents_db():
+    agent = MagicMock()
+    agent.host = 'hv1'
+    agent.binary = 'nova-compute'
+    agent.last_heartbeat_at = '2018-10-01 10:00:00'
+    os_conn = MagicMock()
+    os_conn.network.agents.return_value = [agent]
+    ns4.redis.flushall()
+
+    snapshot = {}
+    ns4.update_agents_db(os_conn, snapshot)
+    assert snapshot == {'agents': {'hv1': {'nova-compute': 1538388000.0}}}
+    assert ns4.redis.get('agents') is None
+    assert ns4.redis.get_stale_hosts(1538388001) == {}
+
+    ns4.update_agents_db(os_conn)
+    assert ns4.redis.get_snapshot('agents') == (1, snapshot)
+    assert ns4.redis.get_stale_hosts(1538388001) == {'hv1': 1538388000.0}
+
+
+def test_probe_hypervisors():
+    ns4.redis.flushall()
+    assert ns4.probe_hypervisors() == []
+
+    ns4.redis.set_inventory('hypervisors', {
+        'hv1': {'host_ip': '10.0.0.1'},
+        'hv2': {'host_ip': '10.0.0.2'},
+    })
+    with patch.object(ns4, 'SCANNER', 'tcp'), \
+            patch.object(ns4, 'tcp_scan', return_value={'10.0.0.1'}):
+        assert ns4.probe_hypervisors() == ['hv2']
+
+    since = time.time() - 60
+    assert ns4.redis.get_unseen(['hv1', 'hv2'], since) == ['hv2']
+
+
+def test_signaling_worker():
+    ns4.redis.flushall()
+    queue = Queue(connection=ns4.redis)
+    ok_job = queue.enqueue(len, [1, 2])
+    failed_job = queue.enqueue(len, None)
+
+    worker = ns4.SignalingSimpleWorker([queue], connection=ns4.redis)
+    worker.work(burst=True)
+
+    job_ids = [ok_job.id, failed_job.id]
+    assert ns4.redis.wait_job_signal(job_ids, 1) == ok_job.id
+    assert ns4.redis.wait_job_signal(job_ids, 1) == failed_job.id
+    assert ok_job.is_finished and failed_job.is_failed
+
+
+def test_refresh_agents():
+    ns4.redis.flushall()
+    with patch.object(ns4, 'update_agents_db') as update_agents_db:
+        ns4.refresh_agents()
+        update_agents_db.assert_called_once_with()
+        assert ns4.redis.get('api_alive') == b'1'
+
+        update_agents_db.side_effect = Exception('OS API Issue')
+        with pytest.raises(Exception):
+            ns4.refresh_agents()
+        assert ns4.redis.get('api_alive') == b'0'
+
+
+def test_get_connection():
+    def connection(**kwargs):
+        def get_access(session):
+            conn.session.auth.auth_ref = access
+            return access
+
+        conn = MagicMock()
+        conn.session.auth.auth_ref = None
+        conn.session.auth.get_access.side_effect = get_access
+        access = MagicMock()
+        access.auth_token = 'token1'
+        access.expires = datetime.datetime.now(datetime.timezone.utc) + \
+            datetime.timedelta(hours=1)
+        conn.session.auth.get_auth_state.return_value = \
+            json.dumps({'auth_token': 'token1', 'body': {}})
+        return conn
+
+    ns4.redis.flushall()
+    with patch.object(ns4, 'OpenStack', side_effect=connection), \
+            patch.object(ns4, 'os_conn_cached', None):
+        conn = ns4.get_connection()
+        assert ns4.get_connection() is conn
+        assert ns4.redis.ttl(ns4.AUTH_STATE_KEY) > 3000
+        conn.session.auth.set_auth_state.assert_not_called()
+
+        # new worker process picks up the cached token
+        ns4.os_conn_cached = None
+        conn = ns4.get_connection()
+        conn.session.auth.set_auth_state.assert_called_once_with(
+            ns4.redis.get(ns4.AUTH_STATE_KEY, str))
+
+
+def test_recover_instances():
+    instances = {
+        'uuid1': {'vm_state': 'active'},
+        'uuid2': {'vm_state': 'stopped'},
+        'uuid3': {'vm_state': 'active'},
+        'uuid4': {'vm_state': 'active'},
+    }
+    os_conn = MagicMock()
+    os_conn.compute.server_interfaces.return_value = [MagicMock(port_id='p')]
+
+    def reboot_server(uuid, reboot_type):
+        if uuid == 'uuid3':
+            raise Exception('reboot failed')
+        time.sleep(0.2)
+
+    os_conn.compute.reboot_server.side_effect = reboot_server
+
+    start = time.time()
+    exceptions = ns4.recover_instances(os_conn, instances, 'hv2', 4)
+    assert time.time() - start < 0.4
+
+    assert exceptions == ['uuid3: reboot failed']
+    assert os_conn.compute.reboot_server.call_count == 3
+    os_conn.network.update_port.assert_called_with(
+        os_conn.get_port.return_value, **{'binding:host_id': 'hv2'})
+    assert os_conn.network.update_port.call_count == 2
+
+
+def test_reassign_instances():
+    db_conn = MagicMock()
+    cursor = db_conn.cursor.return_value.__enter__.return_value
+    cursor.execute.return_value = 2
+
+    with patch.object(ns4, 'db_conn_cached', None), \
+            patch.object(ns4, 'mysql_connect', return_value=db_conn) as \
+            mysql_connect:
+        assert ns4.reassign_instances(['uuid1', 'uuid2'], 'hv2') == 2
+        query, params = cursor.execute.call_args[0]
+        assert 'where uuid in (%s, %s)' in query
+        assert params == ['hv2', 'hv2', 'uuid1', 'uuid2']
+        db_conn.commit.assert_called_once()
+
+        # connection is reused and pinged
+        cursor.execute.side_effect = Exception('deadlock')
+        with pytest.raises(Exception):
+            ns4.reassign_instances(['uuid1'], 'hv2')
+        db_conn.rollback.assert_called_once()
+        db_conn.ping.assert_called_once_with(reconnect=True)
+        mysql_connect.assert_called_once()
+
+        # failed rollback of dropped connection keeps the original error
+        db_conn.rollback.side_effect = Exception('connection lost')
+        with pytest.raises(Exception, match='deadlock'):
+            ns4.reassign_instances(['uuid1'], 'hv2')
+
+
+def test_instance_priority():
+    with patch.object(ns4, 'PROJECT_PRIORITIES', {'p1': 5}):
+        assert ns4.instance_priority(
+            {'metadata': {'sonny_priority': '10'}, 'project_id': 'p1'}) == 10
+        assert ns4.instance_priority(
+            {'metadata': {'sonny_priority': 'x'}, 'project_id': 'p1'}) == 5
+        assert ns4.instance_priority({'metadata': {}, 'project_id': 'p2'}) == 0
+        assert ns4.instance_priority({}) == 0
+
+
+def test_recover_instances_rate_limited():
+    ns4.redis.flushall()
+    instances = {f'uuid{i}': {'vm_state': 'active'} for i in range(3)}
+    os_conn = MagicMock()
+    os_conn.compute.server_interfaces.return_value = []
+    os_conn.compute.get_server.return_value.status = 'ACTIVE'
+
+    with patch.object(ns4, 'RECOVERY_RATE', 10), \
+            patch.object(ns4, 'RECOVERY_MAX_RATE', 20), \
+            patch.object(ns4, 'RECOVERY_BURST', 1), \
+            patch.object(ns4, 'BOOT_LATENCY_TARGET', 60):
+        start = time.time()
+        assert ns4.recover_instances(os_conn, instances, 'hv2', 1) == []
+
+        # reboots follow the given order and wait for bucket refill
+        assert time.time() - start > 0.15
+        reboot_calls = os_conn.compute.reboot_server.call_args_list
+        assert [c[0][0] for c in reboot_calls] == ['uuid0', 'uuid1', 'uuid2']
+        assert ns4.redis.get(ns4.RECOVERY_RATE_KEY, float) > 10
+
+        assert ns4.adapt_recovery_rate(120) < 10
+        assert ns4.redis.ttl(ns4.RECOVERY_RATE_KEY) > 0
+
+        # reboots do not wait for instances to boot
+        ns4.redis.flushall()
+        os_conn.compute.get_server.return_value.status = 'REBOOT'
+        os_conn.compute.reboot_server.reset_mock()
+        start = time.time()
+        assert ns4.recover_instances(os_conn, instances, 'hv2', 1) == []
+        assert os_conn.compute.reboot_server.call_count == 3
+        assert time.time() - start < 3
+        assert ns4.redis.get(ns4.RECOVERY_RATE_KEY) is None
+
+    # boots still in progress past the target when reboots end are slow
+    ns4.redis.flushall()
+    with patch.object(ns4, 'RECOVERY_RATE', 10), \
+            patch.object(ns4, 'RECOVERY_BURST', 3), \
+            patch.object(ns4, 'BOOT_LATENCY_TARGET', 0):
+        assert ns4.recover_instances(os_conn, instances, 'hv2', 1) == []
+        assert ns4.redis.get(ns4.RECOVERY_RATE_KEY, float) < 10
+
+        stopped = threading.Event()
+        stopped.set()
+        assert ns4.wait_for_boot(
+            os_conn, 'uuid0', time.time() - 100, stopped=stopped) >= 100
+
+
+def test_main_openstack_down():
+    with patch.object(ns4, 'get_connection',
+                      side_effect=Exception('keystone down')), \
+            patch.object(ns4, 'get_db_connection',
+                         side_effect=Exception('mysql down')), \
+            patch.object(ns4, 'NS4_WORKER', 'simple'), \
+            patch.object(ns4, 'SignalingSimpleWorker') as worker:
+        ns4.main([])
+        worker.return_value.work.assert_called_once_with()
+        ns4.get_db_connection.assert_not_called()
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    Sonny
+#
+#    Copyright (C) 2018  Marko Kosmerl
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest.mock import patch
+
+import json
+import pytest
+
+import sonny.common.redis
+from sonny.common.codec import dumps, loads
+from sonny.common.redis import (
+    INVENTORY_EVENTS,
+    InventoryCache,
+    decoded_size,
+    diff_entities
+)
+from .fakesonnyredis import FakeSonnyRedis
+
+__author__ = "Marko Kosmerl"
+__copyright__ = "Marko Kosmerl"
+__license__ = "gpl3"
+
+SERVERS = {
+    'uuid1': {'id': 'uuid1', 'name': 'vm1'},
+    'uuid2': {'id': 'uuid2', 'name': 'vm2'},
+}
+
+
+@pytest.fixture(params=['blob', 'hash', 'both'])
+def redis(request):
+    with patch.object(sonny.common.redis, 'INVENTORY_LAYOUT', request.param):
+        yield FakeSonnyRedis()
+
+
+def test_inventory(redis):
+    redis.set_inventory('servers', SERVERS)
+
+    assert redis.get_servers() == SERVERS
+    assert redis.get_servers(['uuid2', 'uuid3']) == {'uuid2': SERVERS['uuid2']}
+    assert redis.get_servers([]) == {}
+    assert redis.get_server('uuid1') == SERVERS['uuid1']
+    assert redis.get_server('uuid3') is None
+
+    redis.update_inventory('servers', {'uuid1': {'id': 'uuid1', 'name': 'x'}})
+    assert redis.get_server('uuid1')['name'] == 'x'
+    assert redis.get_server('uuid2') == SERVERS['uuid2']
+
+    redis.set_inventory('servers', {})
+    assert redis.get_servers() == {}
+
+
+def test_inventory_blob_fallback(redis):
+    redis.set('servers', json.dumps(SERVERS))
+
+    assert redis.get_servers() == SERVERS
+    assert redis.get_server('uuid1') == SERVERS['uuid1']
+
+
+def test_show(redis):
+    redis.set_inventory('servers', SERVERS)
+    redis.set_inventory('hypervisors', {'hv1': {'name': 'hv1'}})
+
+    assert 'vm2' in redis.show('show vm vm2')
+    assert 'vm1' in redis.show('show vm uuid1')
+    assert redis.show('show vm vm3') is None
+    assert 'hv1' in redis.show('show hv hv1')
+    assert redis.show('show hv hv2') is None
+
+
+def test_hypervisor_instances(redis):
+    def server(uuid, hv, ip=None):
+        addresses = {'ext-net': [{'addr': ip}]} if ip else {}
+        return {'id': uuid, 'name': uuid, 'hypervisor_hostname': hv,
+                'addresses': addresses}
+
+    redis.set_servers({
+        'uuid1': server('uuid1', 'hv1', '10.0.0.1'),
+        'uuid2': server('uuid2', 'hv1'),
+        'uuid3': server('uuid3', 'hv2', '10.0.0.3'),
+    })
+    assert redis.get_hypervisor_instances('hv1') == {
+        'uuid1': {'id': 'uuid1', 'name': 'uuid1', 'vm_state': None,
+                  'hypervisor_hostname': 'hv1', 'ips': ['10.0.0.1']},
+        'uuid2': {'id': 'uuid2', 'name': 'uuid2', 'vm_state': None,
+                  'hypervisor_hostname': 'hv1', 'ips': []},
+    }
+    assert redis.get_hypervisor_instances('hv3') == {}
+
+    # move uuid1 to hv2, delete uuid3
+    redis.update_servers(
+        {'uuid1': server('uuid1', 'hv2', '10.0.0.1')}, ['uuid3'])
+    assert list(redis.get_hypervisor_instances('hv1')) == ['uuid2']
+    assert list(redis.get_hypervisor_instances('hv2')) == ['uuid1']
+    assert redis.get_server('uuid3') is None
+
+    # full sync drops stale index entries
+    redis.set_servers({'uuid2': server('uuid2', 'hv1')})
+    assert redis.get_hypervisor_instances('hv2') == {}
+
+
+def test_show_indexed(redis):
+    redis.set_servers({
+        'uuid1': {'id': 'uuid1', 'name': 'web 1'},
+        'uuid2': {'id': 'uuid2', 'name': 'web 2'},
+        'uuid3': {'id': 'uuid3', 'name': 'db'},
+    })
+    redis.update_servers({'uuid3': {'id': 'uuid3', 'name': 'db1'}})
+
+    assert redis.find_servers('web') == {'uuid1': 'web 1', 'uuid2': 'web 2'}
+    assert redis.find_servers('web', exact=True) == {}
+    assert redis.find_servers('db', exact=True) == {}
+    assert redis.find_servers('db1', exact=True) == {'uuid3': 'db1'}
+
+    assert 'uuid2' in redis.show('show vm uuid2')
+    assert 'uuid3' in redis.show('show vm db1')
+    assert redis.show('show vm web') is None
+    assert redis.show('show vm app') is None
+
+    assert redis.show_matches('show vm web') == \
+        ['web 1 (uuid1)', 'web 2 (uuid2)']
+    assert redis.show_matches('show vm app') == []
+    assert redis.show_matches('show hv web') == []
+
+
+def test_snapshot(redis):
+    assert redis.get_snapshot('agents', 'hypervisors') == \
+        (0, {'agents': None, 'hypervisors': {}})
+
+    hypervisors = {'hv1': {'vcpus': 32}}
+    agents = {'hv1': {'nova-compute': 1538388000.0}}
+    assert redis.set_snapshot(
+        {'agents': agents, 'hypervisors': hypervisors}) == 1
+    assert redis.set_snapshot({'aggregates': {'hv1': 'agg1'}}) == 2
+
+    assert redis.get_snapshot('agents', 'hypervisors', 'aggregates') == \
+        (2, {'agents': agents, 'hypervisors': hypervisors,
+             'aggregates': {'hv1': 'agg1'}})
+    assert redis.get_hypervisor('hv1') == {'vcpus': 32}
+    assert redis.get('agents:timestamp', float)
+
+
+def test_diff_entities():
+    old = {'hv1': {'state': 'up'}, 'hv2': {'state': 'up'}, 'hv4': 'a'}
+    new = {'hv1': {'state': 'down'}, 'hv3': {'state': 'up'}, 'hv4': 'b'}
+
+    assert diff_entities(old, new) == {
+        'added': ['hv3'],
+        'removed': ['hv2'],
+        'changed': {'hv1': {'state': 'down'}, 'hv4': 'b'}
+    }
+    assert diff_entities(None, {'hv1': {}})['added'] == ['hv1']
+
+
+def test_snapshot_changes(redis):
+    hypervisors = {'hv1': {'state': 'up'}, 'hv2': {'state': 'up'}}
+    assert redis.set_snapshot({'hypervisors': hypervisors}) == 1
+    assert redis.set_snapshot({'hypervisors': hypervisors}) == 1
+    assert redis.xlen(INVENTORY_EVENTS) == 1
+
+    hypervisors = {'hv1': {'state': 'down'}, 'hv3': {'state': 'up'}}
+    assert redis.set_snapshot({'hypervisors': hypervisors}) == 2
+    assert redis.xlen(INVENTORY_EVENTS) == 2
+    assert redis.get_hypervisors() == hypervisors
+
+
+def test_servers_events(redis):
+    servers = {'uuid1': {'name': 'vm1', 'hypervisor_hostname': 'hv1'}}
+    redis.set_servers(servers)
+    redis.set_servers(servers)
+    assert redis.xlen(INVENTORY_EVENTS) == 1
+
+    redis.update_servers(
+        {'uuid1': {'name': 'vm1', 'hypervisor_hostname': 'hv2'}})
+    assert redis.xlen(INVENTORY_EVENTS) == 2
+
+    redis.set_servers(servers)
+    assert list(redis.get_hypervisor_instances('hv1')) == ['uuid1']
+
+
+def test_get_events(redis):
+    redis.set_snapshot({'hypervisors': {'hv1': {'state': 'up'}}})
+    redis.set_snapshot({'hypervisors': {'hv1': {'state': 'down'}}})
+
+    events = redis.get_events()
+    assert [(dataset, event) for _, dataset, event in events] == [
+        ('hypervisors', {'added': ['hv1'], 'removed': [], 'changed': {}}),
+        ('hypervisors', {'added': [], 'removed': [],
+                         'changed': {'hv1': {'state': 'down'}}}),
+    ]
+    assert redis.get_events(events[0][0]) == events[1:]
+
+    # heartbeat churn of agents is not an event
+    redis.set_snapshot({'agents': {'hv1': {'nova-compute': 90.0}}})
+    redis.set_snapshot({'agents': {'hv1': {'nova-compute': 100.0}}})
+    events = redis.get_events(events[-1][0])
+    assert [(dataset, event) for _, dataset, event in events] == [
+        ('agents', {'added': ['hv1'], 'removed': [], 'changed': {}}),
+    ]
+    assert redis.get_snapshot('agents')[1] == {
+        'agents': {'hv1': {'nova-compute': 100.0}}}
+
+
+def test_inventory_cache():
+    cache = InventoryCache(10)
+    cache.put('a', b'1', 'A', 4)
+    cache.put('b', b'1', 'B', 4)
+
+    assert cache.get('a', b'2') is None
+    assert cache.get('a', b'1')[1] == 'A'
+
+    # b is least recently used
+    cache.put('c', b'1', 'C', 4)
+    assert cache.get('b', b'1') is None
+    assert cache.get('a', b'1') and cache.get('c', b'1')
+    assert cache.size == 8
+
+    cache.put('d', b'1', 'D', 11)
+    assert cache.get('d', b'1') is None
+
+
+def test_snapshot_cache(redis):
+    aggregates = {'hv1': 'agg1'}
+    redis.set_snapshot({'aggregates': aggregates, 'agents': {}})
+
+    _, first = redis.get_snapshot('aggregates', 'agents')
+    _, second = redis.get_snapshot('aggregates')
+    assert first['aggregates'] == aggregates
+    assert first['aggregates'] is second['aggregates']
+    assert redis.get('aggregates', loads) is first['aggregates']
+
+    redis.set_snapshot({'aggregates': {'hv1': 'agg2'}})
+    assert redis.get_snapshot('aggregates')[1]['aggregates'] == \
+        {'hv1': 'agg2'}
+
+    # updates do not modify the shared cached inventory
+    redis.set_servers({'uuid1': {'name': 'vm1', 'hypervisor_hostname': 'hv1'}})
+    servers = redis.get_servers()
+    redis.update_servers({'uuid2': {'name': 'vm2'}})
+    assert servers == {'uuid1': {'name': 'vm1', 'hypervisor_hostname': 'hv1'}}
+    assert redis.get_servers() == {
+        'uuid1': {'name': 'vm1', 'hypervisor_hostname': 'hv1'},
+        'uuid2': {'name': 'vm2'},
+    }
+
+    # bounded by decoded size, which is larger than the encoded one
+    assert redis._cache.size >= decoded_size({'hv1': 'agg2'})
+    assert decoded_size({'hv1': 'agg2'}) > len(dumps({'hv1': 'agg2'}))
+
+    uncached = FakeSonnyRedis(cache_size=0)
+    uncached.set_snapshot({'aggregates': aggregates})
+    assert uncached.get_snapshot('aggregates')[1]['aggregates'] is not \
+        uncached.get_snapshot('aggregates')[1]['aggregates']
+
+
+def test_stream_servers():
+    def server(uuid, hv):
+        return {'id': uuid, 'name': f'vm-{uuid}', 'hypervisor_hostname': hv}
+
+    with patch.object(sonny.common.redis, 'INVENTORY_LAYOUT', 'hash'):
+        redis = FakeSonnyRedis()
+        redis.set_servers({
+            'uuid1': server('uuid1', 'hv1'),
+            'uuid2': server('uuid2', 'hv2'),
+        })
+
+        servers = [server('uuid2', 'hv3'), server('uuid3', 'hv3'),
+                   server('uuid4', None)]
+        redis.stream_servers(iter(servers), page_size=2)
+
+        assert redis.get_servers() == {s['id']: s for s in servers}
+        assert redis.get_hypervisor_instances('hv1') == {}
+        assert redis.get_hypervisor_instances('hv2') == {}
+        assert set(redis.get_hypervisor_instances('hv3')) == \
+            {'uuid2', 'uuid3'}
+        assert redis.find_servers('vm-uuid1') == {}
+        assert redis.find_servers('vm-uuid4') == {'uuid4': 'vm-uuid4'}
+        assert not redis.keys('*staging*')
+        assert redis.xlen(INVENTORY_EVENTS) == 2
+
+        # unchanged inventory is not swapped in again
+        redis.stream_servers(iter(servers), page_size=2)
+        assert redis.xlen(INVENTORY_EVENTS) == 2
+        assert not redis.keys('*staging*')
+
+        redis.stream_servers(iter([]))
+        assert redis.get_servers() == {}
+        assert redis.get_hypervisor_instances('hv3') == {}
+
+        # overlapping full syncs stage under their own keys
+        def overlapping():
+            yield server('uuid1', 'hv1')
+            redis.stream_servers(iter([server('uuid2', 'hv2')]))
+            assert redis.get_servers() == {'uuid2': server('uuid2', 'hv2')}
+            staged = redis.keys('*staging*')
+            assert staged and all(redis.ttl(key) > 0 for key in staged)
+            yield server('uuid3', 'hv3')
+
+        redis.stream_servers(overlapping(), page_size=1)
+        assert redis.get_servers() == {
+            'uuid1': server('uuid1', 'hv1'), 'uuid3': server('uuid3', 'hv3')}
+        assert redis.get_hypervisor_instances('hv2') == {}
+        assert not redis.keys('*staging*')
+        assert redis.get_events()[-1][2]['removed'] == ['uuid2']
+
+        # staged keys expired before the swap leave live servers intact
+        def expiring():
+            yield server('uuid4', 'hv4')
+            redis.delete(*redis.keys('*staging*'))
+
+        with pytest.raises(Exception, match='expired'):
+            redis.stream_servers(expiring(), page_size=1)
+        assert set(redis.get_servers()) == {'uuid1', 'uuid3'}
+
+
+def test_last_seen(redis):
+    assert redis.get_unseen(['hv1'], 100) is None
+
+    redis.set_last_seen({'hv1', 'hv2'}, 100)
+    redis.set_last_seen({'hv1'}, 110)
+    assert redis.get_unseen(['hv1', 'hv2', 'hv3'], 105) == ['hv2', 'hv3']
+    assert redis.get_unseen(['hv1'], 105) == []
+    # seen by an older sweep only is not up
+    assert redis.get_unseen(['hv1', 'hv2'], 90) == ['hv2']
+    assert redis.get_unseen(['hv1'], 120) is None
+
+
+def test_job_signal():
+    redis = FakeSonnyRedis()
+    redis.signal_job('job2')
+    assert redis.wait_job_signal(['job1', 'job2'], 1) == 'job2'
+    assert redis.wait_job_signal(['job1', 'job2'], 0.1) is None
+
+
+def test_heartbeats(redis):
+    assert redis.get_stale_hosts(100) == {}
+
+    redis.set_heartbeats({
+        'hv1': {'nova-compute': 90.0, 'openvswitch-agent': 120.0},
+        'hv2': {'nova-compute': 80.0},
+        'hv3': {},
+    })
+    assert redis.get_stale_hosts(100) == {'hv2': 80.0}
+    assert redis.get_stale_hosts(80) == {}
+
+    redis.set_heartbeats({'hv1': {'nova-compute': 90.0}})
+    assert redis.get_stale_hosts(100) == {'hv1': 90.0}
+
+    # agents snapshot replaces the index in the same transaction
+    redis.set_snapshot({'agents': {'hv2': {'nova-compute': 95.0}}})
+    assert redis.get_stale_hosts(100) == {'hv2': 95.0}
+
+
+def test_spare_pool(redis):
+    def service(state='up', status='enabled', reason=None, zone='az1'):
+        return {'state': state, 'status': status, 'disables_reason': reason,
+                'zone': zone}
+
+    def hypervisor(vcpus, vcpus_used=0):
+        return {'vcpus': vcpus, 'vcpus_used': vcpus_used}
+
+    services = {
+        'hv1': service(state='down'),
+        'hv2': service(state='down'),
+        'hv3': service(state='down', zone='az2'),
+        'spare1': service(status='disabled', reason='Spare'),
+        'spare2': service(status='disabled', reason='sonny spare'),
+        'spare3': service(status='disabled', reason='spare'),
+        'spare4': service(status='disabled', reason='spare', zone='az2'),
+        'used': service(status='disabled', reason='spare'),
+    }
+    aggregates = {host: 'agg1' for host in services}
+    aggregates['spare3'] = 'agg2'
+    hypervisors = {
+        'hv1': hypervisor(32, 16), 'hv2': hypervisor(16, 16),
+        'hv3': hypervisor(64, 8), 'spare1': hypervisor(64),
+        'spare2': hypervisor(32), 'spare3': hypervisor(32),
+        'spare4': hypervisor(32), 'used': hypervisor(64, 4),
+    }
+
+    assert redis.claim_spares(['hv1']) is None
+    redis.set_spare_pool(services, aggregates, hypervisors)
+
+    # spare4 is too small for hv3, nothing is claimed
+    assert redis.claim_spares(['hv1', 'hv3']) == {'hv1': 'spare2', 'hv3': None}
+
+    # best fit: larger hv1 gets spare2 and hv2 what is left
+    assert redis.claim_spares(['hv2', 'hv1']) == \
+        {'hv2': 'spare1', 'hv1': 'spare2'}
+    assert redis.get('spare:spare2:claimed') == b'hv1'
+    assert redis.claim_spares(['hv2']) == {'hv2': None}
+
+    # claimed spares stay out of the rebuilt index
+    redis.set_spare_pool(services, aggregates, hypervisors)
+    assert redis.claim_spares(['hv2']) == {'hv2': None}
+
+    redis.delete('spare:spare1:claimed')
+    redis.set_spare_pool(services, aggregates, hypervisors)
+    assert redis.claim_spares(['hv2']) == {'hv2': 'spare1'}
+
+
+def test_take_token():
+    redis = FakeSonnyRedis()
+    assert redis.take_token('bucket', 1, 2) == 0
+    assert redis.take_token('bucket', 1, 2) == 0
+    assert 0.9 < redis.take_token('bucket', 1, 2) <= 1
+
+    redis.hset('bucket', 'timestamp', float(redis.hget('bucket', 'timestamp'))
+               - 10)
+    assert redis.take_token('bucket', 1, 2) == 0
+    assert redis.take_token('bucket', 1, 2) == 0
+    assert redis.take_token('bucket', 1, 2) > 0
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    Sonny
+#
+#    Copyright (C) 2018  Marko Kosmerl
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest.mock import patch
+
+import asyncio
+import socket
+
+import sonny.ns4 as ns4
+from sonny.common.scan import tcp_scan
+
+__author__ = "Marko Kosmerl"
+__copyright__ = "Marko Kosmerl"
+__license__ = "gpl3"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_tcp_scan():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    open_port = listener.getsockname()[1]
+
+    try:
+        # open and refused ports mean host is up
+        assert tcp_scan(['127.0.0.1'], [open_port]) == {'127.0.0.1'}
+        assert tcp_scan(['127.0.0.1'], [free_port()]) == {'127.0.0.1'}
+
+    finally:
+        listener.close()
+
+
+def test_tcp_scan_timeout():
+    attempts = []
+
+    async def no_response(host, port):
+        attempts.append(host)
+        await asyncio.sleep(1)
+
+    with patch('asyncio.open_connection', no_response):
+        assert tcp_scan(['10.0.0.1', '10.0.0.2'], [22, 111],
+                        timeout=0.1, retries=1) == set()
+
+    # scanned ports and host discovery ports 80 and 443
+    assert len(attempts) == 16
+
+
+def test_tcp_scan_discovery():
+    async def connect(host, port):
+        if port == 443:
+            raise ConnectionRefusedError()
+        await asyncio.sleep(1)
+
+    # scanned port filtered, host found up by discovery like with nmap
+    with patch('asyncio.open_connection', connect):
+        assert tcp_scan(['10.0.0.1'], [22], timeout=0.1, retries=0) == \
+            {'10.0.0.1'}
+
+
+def test_nmap_scan_tcp():
+    with patch.object(ns4, 'SCANNER', 'tcp'), \
+            patch.object(ns4, 'tcp_scan', return_value={'10.0.0.1'}):
+        assert ns4.nmap_scan(['10.0.0.1', '10.0.0.2']) == ['10.0.0.2']
+
+
+def test_tcp_scan_first():
+    attempts = []
+
+    async def connect(host, port):
+        attempts.append(host)
+        if host != '10.0.0.1':
+            await asyncio.sleep(1)
+        raise ConnectionRefusedError()
+
+    with patch('asyncio.open_connection', connect):
+        assert tcp_scan(['10.0.0.1', '10.0.0.2', '10.0.0.3'], [22],
+                        timeout=0.5, retries=1, first=True) == {'10.0.0.1'}
+
+
+def test_probe_any():
+    hosts = [f'10.0.0.{i}' for i in range(1, 11)]
+    scanned = []
+
+    def scan(host_list, port_list, first=False):
+        scanned.append(len(host_list))
+        return {'10.0.0.7'} & set(host_list)
+
+    with patch.object(ns4, 'SCANNER', 'tcp'), \
+            patch.object(ns4, 'tcp_scan', side_effect=scan):
+        assert ns4.probe_any(hosts, sample_size=2) == ['10.0.0.7']
+        assert scanned[0] == 2
+        assert all(b == 2 * a for a, b in zip(scanned, scanned[1:-1]))
+
+        scanned.clear()
+        assert ns4.probe_any(hosts[:6], sample_size=2) == []
+        assert scanned == [2, 4]